@@ -0,0 +1,172 @@
+"""End to end benchmark of a netimpact run against the local stand-in servers.
+
+    python -m benchmarks.run --scale 100k --networks awin,admitad --throttle 0.02 --latency-ms 20
+
+Times Impact.get_partners, the network publisher lists, Impact.partner_update, processor.transactions_process and
+Impact.batch_to_impact per stage and network, and prints the seconds and rows per second of each stage.
+"""
+import contextlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+import click
+
+from benchmarks.servers import FakeServers, FakeFTP, local_transport
+from benchmarks.synthetic import SCALES, Dataset
+from netimpact import processor as P
+from netimpact.admitad import Admitad
+from netimpact.awin import AWin
+from netimpact.ftpupload import FTPUploader
+from netimpact.impact import Impact
+from netimpact.linkshare import Linkshare
+
+# network name -> (account name, account ID)
+ACCOUNTS = {
+    'awin': ('Awin UK', '1001'),
+    'admitad': ('Admitad RU', '2001'),
+    'linkshare': ('Linkshare US', 'benchmark-token'),
+}
+FTP_USER = 'benchmark'
+FTP_PASSWORD = 'benchmark'
+
+
+def build_network(name, transport, awin_slice_hours):
+    if name == 'awin':
+        return AWin('benchmark-token', transport=transport, slice_hours=awin_slice_hours)
+    if name == 'admitad':
+        return Admitad('benchmark-id', 'benchmark-secret', transport=transport)
+    return Linkshare('Transactions', 'Publishers', transport=transport)
+
+
+def count_rows(*paths):
+    """Data rows in the CSV files, header excluded"""
+    rows = 0
+    for path in paths:
+        if os.path.exists(path):
+            with open(path) as f:
+                rows += max(sum(1 for _ in f) - 1, 0)
+    return rows
+
+
+class Stages:
+    """Stage timings in the order they ran"""
+    def __init__(self):
+        self.results = []
+
+    @contextlib.contextmanager
+    def time(self, stage, network=''):
+        result = {'stage': stage, 'network': network, 'seconds': 0.0, 'rows': 0}
+        start = time.perf_counter()
+        # The Impact client prints progress bars and group lists to stdout
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            yield result
+        result['seconds'] = time.perf_counter() - start
+        result['rows_per_second'] = result['rows'] / result['seconds'] if result['seconds'] else 0.0
+        self.results.append(result)
+
+    def table(self):
+        lines = [f'{"stage":<22}{"network":<12}{"seconds":>10}{"rows":>10}{"rows/s":>12}']
+        for r in self.results:
+            lines.append(f'{r["stage"]:<22}{r["network"]:<12}{r["seconds"]:>10.2f}{r["rows"]:>10}{r["rows_per_second"]:>12.0f}')
+        return '\n'.join(lines)
+
+
+@click.command()
+@click.option('--scale', type=click.Choice(list(SCALES)), default='1k', show_default=True, help='Transactions per day and publishers per network')
+@click.option('--networks', default='awin,admitad,linkshare', show_default=True, help='Comma separated networks to run')
+@click.option('--throttle', type=float, default=0.0, show_default=True, help='Share of API requests answered with a 429')
+@click.option('--latency-ms', type=float, default=0.0, show_default=True, help='Added latency of every API request in milliseconds')
+@click.option('--engine', type=click.Choice(P.ENGINES), default='python', show_default=True, help='Transform engine')
+@click.option('--page-workers', type=int, default=1, show_default=True, help='Impact page_workers')
+@click.option('--partner-workers', type=int, default=1, show_default=True, help='Impact partner_workers')
+@click.option('--awin-slice-hours', type=int, default=24, show_default=True, help='Awin slice_hours')
+@click.option('--ftp/--no-ftp', default=True, show_default=True, help='Run the batch FTP upload stage (needs pyftpdlib)')
+@click.option('--json', 'json_path', type=click.Path(), default=None, help='Also write the results to this JSON file')
+def main(scale, networks, throttle, latency_ms, engine, page_workers, partner_workers, awin_slice_hours, ftp, json_path):
+    logging.basicConfig(level=logging.ERROR)
+    names = [n.strip().lower() for n in networks.split(',') if n.strip()]
+    for name in names:
+        if name not in ACCOUNTS:
+            raise click.BadParameter(f'expected some of {", ".join(ACCOUNTS)}', param_hint='--networks')
+
+    dataset = Dataset.scale(scale)
+    servers = FakeServers(dataset, group_names=[], throttle=throttle, latency=latency_ms / 1000).start()
+    workdir = tempfile.TemporaryDirectory(prefix='netimpact-benchmark-')
+    ftp_server = None
+    if ftp:
+        try:
+            os.mkdir(os.path.join(workdir.name, 'ftp'))
+            ftp_server = FakeFTP(os.path.join(workdir.name, 'ftp'), FTP_USER, FTP_PASSWORD).start()
+        except ImportError:
+            logging.error('pyftpdlib is not installed, skipping the batch_to_impact stage')
+    transport = local_transport(servers.port, pool_maxsize=max(page_workers, partner_workers, 10))
+    uploader = FTPUploader(FTP_USER, FTP_PASSWORD, host='127.0.0.1', port=ftp_server.port if ftp_server else 21, retry_delay=0.1)
+    i = Impact('benchmark-sid', 'benchmark-token', FTP_USER, FTP_PASSWORD, '1000', '1', '2', page_workers=page_workers,
+               transport=transport, ftp_uploader=uploader, partner_workers=partner_workers)
+    stages = Stages()
+    cwd = os.getcwd()
+    os.chdir(workdir.name)
+    try:
+        with stages.time('get_partners') as s:
+            partners = i.get_partners()
+            s['rows'] = len(partners)
+        i.existing_partner_dict = partners
+
+        for name in names:
+            account_name, account_id = ACCOUNTS[name]
+            n = build_network(name, transport, awin_slice_hours)
+            with stages.time('get_pubs', name) as s:
+                pubs = n.get_pubs(account_id)
+                s['rows'] = len(pubs)
+            with stages.time('partner_update', name) as s:
+                i.ensure_group(n.network_name)
+                i.ensure_group(account_name)
+                i.partner_update(account_name, n.network_name, pubs)
+                s['rows'] = len(pubs)
+            with stages.time('transactions_process', name) as s:
+                file_path_m, file_path_p = P.transactions_process(i, account_id, account_name, n, dataset.day, engine=engine)
+                s['rows'] = count_rows(file_path_m, file_path_p)
+            if ftp_server is not None:
+                with stages.time('batch_to_impact', name) as s:
+                    s['rows'] = count_rows(file_path_m, file_path_p)
+                    failed = i.batch_to_impact(file_path_m, file_path_p)
+                    if failed:
+                        logging.error(f'Upload failed for {", ".join(map(str, failed))}')
+                    s['rows'] -= count_rows(*failed)
+    finally:
+        os.chdir(cwd)
+        uploader.close()
+        transport.close()
+        servers.stop()
+        if ftp_server is not None:
+            ftp_server.stop()
+        workdir.cleanup()
+
+    click.echo(f'scale {scale}: {dataset.transactions} transactions, {dataset.publishers} publishers per network, '
+               f'throttle {throttle}, latency {latency_ms:g} ms')
+    click.echo(stages.table())
+    click.echo(f'API requests: {json.dumps(servers.requests, sort_keys=True)}')
+    if json_path:
+        report = {
+            'scale': scale,
+            'transactions': dataset.transactions,
+            'publishers': dataset.publishers,
+            'networks': names,
+            'throttle': throttle,
+            'latency_ms': latency_ms,
+            'engine': engine,
+            'page_workers': page_workers,
+            'partner_workers': partner_workers,
+            'awin_slice_hours': awin_slice_hours,
+            'stages': stages.results,
+            'requests': servers.requests,
+        }
+        with open(os.path.join(cwd, json_path) if not os.path.isabs(json_path) else json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
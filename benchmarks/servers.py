@@ -0,0 +1,349 @@
+"""Local stand-in servers for the Awin, Admitad, Linkshare and Impact REST APIs and the Impact batch FTP.
+
+One threaded HTTP server answers for every API under a path prefix per host. A transport built by local_transport
+sends the real client URLs (https://api.awin.com/..., https://api.impact.com/...) to it, so the clients run unmodified.
+Every request can be delayed by a fixed latency and answered with a 429 (Retry-After: 0) at a given rate.
+"""
+import csv
+import io
+import json
+import math
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit, urlunsplit
+
+from requests.adapters import HTTPAdapter
+
+from benchmarks.synthetic import COUNTRIES, COUNTRY_NAMES
+from netimpact.ratelimit import RateLimiter
+from netimpact.transport import Transport
+
+HOSTS = {
+    'api.awin.com': 'awin',
+    'api.admitad.com': 'admitad',
+    'ran-reporting.rakutenmarketing.com': 'linkshare',
+    'api.impact.com': 'impact',
+}
+ADMITAD_STATUSES = {'0': 'pending', '1': 'approved', '2': 'declined'}
+LINKSHARE_HEADERS = ['Consumer Country', 'Gross Commissions', 'Gross Sales', 'Order ID', 'Publisher ID', 'Transaction Date',
+                     'Transaction Time', 'Process Date', 'Customer Status', 'Currency']
+
+
+class ImpactProgram:
+    """In memory Impact program: partners, groups and their members"""
+    def __init__(self, dataset, group_names, partner_ids_in_response=True):
+        self.lock = threading.Lock()
+        self.partners = [(str(n), str(100000 + n)) for n in dataset.existing_publishers()] # (MPValue1, Id) in creation order
+        self.next_partner_id = 200000
+        self.groups = {name: str(1000 + n) for n, name in enumerate(group_names)}
+        self.members = {gid: set() for gid in self.groups.values()}
+        self.partner_ids_in_response = partner_ids_in_response
+
+    def create_partner(self, mpvalue1):
+        with self.lock:
+            self.next_partner_id += 1
+            self.partners.append((mpvalue1, str(self.next_partner_id)))
+            return str(self.next_partner_id)
+
+    def create_group(self, name):
+        with self.lock:
+            gid = str(1000 + len(self.groups))
+            self.groups[name] = gid
+            self.members[gid] = set()
+            return gid
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def dispatch(self, method):
+        servers = self.server.fakes
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        url = urlsplit(self.path)
+        service, _, path = url.path.lstrip('/').partition('/')
+        params = {k: v[-1] for k, v in parse_qs(url.query, keep_blank_values=True).items()}
+        servers.count(service)
+        if servers.latency:
+            time.sleep(servers.latency)
+        if servers.throttled():
+            servers.count('429')
+            return self.send_json({'error': 'Too Many Requests'}, status=429, headers={'Retry-After': '0'})
+        handler = getattr(self, f'{service}_{method.lower()}', None)
+        if handler is None:
+            return self.send_json({'error': 'Not Found'}, status=404)
+        handler('/' + path, params)
+
+    def send_json(self, body, status=200, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_csv(self, rows):
+        """Stream CSV rows without a Content-Length and close the connection, like a large report download"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv; charset=utf-8')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for n, row in enumerate(rows):
+            writer.writerow(row)
+            if n % 1000 == 999:
+                self.wfile.write(buffer.getvalue().encode())
+                buffer.seek(0)
+                buffer.truncate()
+        self.wfile.write(buffer.getvalue().encode())
+
+    # Awin
+    def awin_get(self, path, params):
+        data = self.server.fakes.dataset
+        if path.endswith('/publishers'):
+            return self.send_json([{'id': p['id'], 'name': p['name']} for p in map(data.publisher, range(1, data.publishers + 1))])
+        start = self.second_of_day(params['startDate'], data.day)
+        end = self.second_of_day(params['endDate'], data.day)
+        status = params.get('status', 'pending')
+        transactions = []
+        for k in data.index_range(status, start, end):
+            t = data.transaction(status, k)
+            country = COUNTRIES[t['country']]
+            transactions.append({
+                'id': t['id'],
+                'type': 'Mobile Sale' if t['mobile'] else 'Sale',
+                'status': status,
+                'transactionDate': t['time'],
+                'publisherId': t['publisherId'],
+                'saleAmount': {'amount': t['sale'], 'currency': t['currency']},
+                'commissionAmount': {'amount': t['commission'], 'currency': t['currency']},
+                'voucherCode': t['voucher'],
+                'customerCountry': country,
+                'advertiserCountry': country,
+                'transactionParts': [{'commissionGroupName': 'New Customer' if t['new'] else 'Existing Customer'}],
+            })
+        self.send_json(transactions)
+
+    def second_of_day(self, value, day):
+        """Seconds from the start of the dataset day to an Awin date parameter, outside 0..DAY_SECONDS for other days"""
+        return int((datetime.strptime(value, '%Y-%m-%dT%H:%M:%S') - day).total_seconds())
+
+    # Admitad
+    def admitad_post(self, path, params):
+        self.send_json({'access_token': 'benchmark-token', 'expires_in': 604800})
+
+    def admitad_get(self, path, params):
+        data = self.server.fakes.dataset
+        offset, limit = int(params.get('offset', 0)), int(params.get('limit', 20))
+        if path.rstrip('/').endswith('/websites'):
+            ids = range(offset + 1, min(offset + limit, data.publishers) + 1)
+            results = [{'website': {'id': p['id'], 'name': p['name'], 'site_url': p['site']}, 'user': {'name': 'User'}}
+                       for p in map(data.publisher, ids)]
+            return self.send_json({'results': results, '_meta': {'count': data.publishers, 'offset': offset, 'limit': limit}})
+        status = ADMITAD_STATUSES[params.get('status', '0')]
+        count = data.count(status)
+        results = []
+        for k in range(offset, min(offset + limit, count)):
+            t = data.transaction(status, k)
+            results.append({
+                'id': t['id'],
+                'action_time': t['time'].replace('T', ' '),
+                'order_sum': t['sale'],
+                'payment_webmaster': t['commission'],
+                'currency': t['currency'],
+                'website_id': t['publisherId'],
+                'promocode': t['voucher'],
+                'action_country': COUNTRIES[t['country']],
+                'product_id': 1636 if t['new'] else 1,
+                'product_name': 'мобильный' if t['mobile'] else 'desktop',
+            })
+        self.send_json({'results': results, '_meta': {'count': count, 'offset': offset, 'limit': limit}})
+
+    # Linkshare
+    def linkshare_get(self, path, params):
+        data = self.server.fakes.dataset
+        if 'start_date' not in params:
+            header = ['Member ID', 'Advertiser ID', 'Advertiser Name', 'Publisher ID', 'Publisher Name', 'Publisher URL']
+            rows = ([1, 1, 'Advertiser', p['id'], p['name'], p['site']] for p in map(data.publisher, range(1, data.publishers + 1)))
+            return self.send_csv([header, *rows])
+        day = data.day
+        def rows():
+            yield LINKSHARE_HEADERS
+            for t in data.iter_transactions():
+                process_day = day if t['status'] == 'pending' else day + timedelta(1)
+                yield [COUNTRY_NAMES[t['country']], f"{t['commission']:,.2f}", f"{t['sale']:,.2f}", t['id'], t['publisherId'],
+                       f'{day.month}/{day.day}/{day:%y}', t['time'].split('T')[1], f'{process_day.month}/{process_day.day}/{process_day:%y}',
+                       'New' if t['new'] else 'Returning', t['currency']]
+        self.send_csv(rows())
+
+    # Impact
+    def impact_get(self, path, params):
+        program = self.server.fakes.program
+        if path.endswith('/Contracts.json'):
+            return self.send_json({'Contracts': [{'TemplateTerms': {'TemplateId': '1'}}]})
+        if path.endswith('/MediaPartnerGroups.json'):
+            with program.lock:
+                groups = [{'Name': name, 'Id': gid} for name, gid in program.groups.items()]
+            return self.send_json({'Groups': groups})
+        if '/MediaPartnerGroups/' in path:
+            gid = path.rsplit('/', 1)[-1].split('.')[0]
+            with program.lock:
+                members = [{'Id': p} for p in program.members.get(gid, ())]
+            return self.send_json({'MediaPartners': members})
+        if path.endswith('/MediaPartners'):
+            page_size, page = int(params.get('PageSize', 100)), int(params.get('Page', 1))
+            with program.lock:
+                partners = program.partners[(page - 1) * page_size:page * page_size]
+                numpages = math.ceil(len(program.partners) / page_size)
+            return self.send_json({
+                '@page': str(page),
+                '@numpages': str(numpages),
+                '@nextpageuri': f'{path}?CampaignId={params.get("CampaignId")}&PageSize={page_size}&Page={page + 1}' if page < numpages else '',
+                'MediaPartners': [{'Id': pid, 'MPValue1': mpvalue1} for mpvalue1, pid in partners],
+            })
+        self.send_json({'error': 'Not Found'}, status=404)
+
+    def impact_post(self, path, params):
+        program = self.server.fakes.program
+        if path.endswith('/MediaPartnerGroups'):
+            gid = program.create_group(params['Name'])
+            return self.send_json({'Uri': f'{path}/{gid}'})
+        if path.endswith('/MediaPartners'):
+            pid = program.create_partner(params['MPValue1'])
+            if program.partner_ids_in_response:
+                return self.send_json({'Id': pid})
+            # What the live API does today, see Impact.create_partner
+            return self.send_json({'Status': 'ERROR'}, status=500)
+        self.send_json({'error': 'Not Found'}, status=404)
+
+    def impact_put(self, path, params):
+        program = self.server.fakes.program
+        gid = path.rsplit('/', 1)[-1]
+        with program.lock:
+            program.members.setdefault(gid, set()).update(p for p in params.get('MediaPartnersAdd', '').split(',') if p)
+        self.send_json({'Status': 'OK'})
+
+
+class FakeServers:
+    """Threaded HTTP server answering for every API, on a free local port
+
+    Arguments:
+        dataset {Dataset} -- Synthetic data served
+        group_names {list} -- Groups that already exist in the Impact program
+
+    Keyword Arguments:
+        throttle {float} -- Share of requests answered with a 429 (default: {0})
+        latency {float} -- Seconds every request is delayed by (default: {0})
+        partner_ids_in_response {bool} -- Answer partner creation with the new ID instead of the 500 the live API gives (default: {True})
+        seed {int} -- Seed for the 429 injection (default: {0})
+    """
+    def __init__(self, dataset, group_names, throttle=0.0, latency=0.0, partner_ids_in_response=True, seed=0):
+        self.dataset = dataset
+        self.program = ImpactProgram(dataset, group_names, partner_ids_in_response)
+        self.throttle = throttle
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.requests = {}
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.fakes = self
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def throttled(self):
+        with self.lock:
+            return self.throttle > 0 and self.random.random() < self.throttle
+
+    def count(self, key):
+        with self.lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FakeFTP:
+    """Impact batch FTP stand-in on a free local port, storing uploads in directory. Needs pyftpdlib.
+
+    Arguments:
+        directory {string} -- Directory uploads are written to
+        username {string} -- FTP username
+        password {string} -- FTP password
+    """
+    def __init__(self, directory, username, password):
+        from pyftpdlib.authorizers import DummyAuthorizer
+        from pyftpdlib.handlers import FTPHandler
+        from pyftpdlib.servers import ThreadedFTPServer
+        authorizer = DummyAuthorizer()
+        authorizer.add_user(username, password, directory, perm='elradfmwMT')
+        handler = type('BenchmarkFTPHandler', (FTPHandler,), {'authorizer': authorizer})
+        self.server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+        self.port = self.server.address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'handle_exit': False}, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.close_all()
+
+
+class RedirectAdapter(HTTPAdapter):
+    """Sends requests for the real API hosts to the local server, under the host's path prefix"""
+    def __init__(self, port, **kwargs):
+        self.port = port
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        if url.hostname in HOSTS:
+            request.url = urlunsplit(('http', f'127.0.0.1:{self.port}', f'/{HOSTS[url.hostname]}{url.path}', url.query, ''))
+        return super().send(request, **kwargs)
+
+
+def local_transport(port, rate=1000, pool_maxsize=32):
+    """Transport whose requests to the API hosts go to the local server, with rate limits high enough not to be the bottleneck
+
+    Arguments:
+        port {int} -- Port of the FakeServers
+
+    Keyword Arguments:
+        rate {float} -- Starting and maximum requests per second per host (default: {1000})
+        pool_maxsize {int} -- Connections kept per host (default: {32})
+
+    Returns:
+        Transport -- Transport to pass to Impact and the network objects
+    """
+    limits = {host: {'rate': rate, 'burst': rate, 'max_rate': rate, 'increase': rate / 20} for host in HOSTS}
+    transport = Transport(pool_maxsize=pool_maxsize, rate_limiter=RateLimiter(limits, backoff=0.01))
+    adapter = RedirectAdapter(port, pool_connections=len(HOSTS), pool_maxsize=pool_maxsize)
+    transport.session.mount('https://', adapter)
+    transport.session.mount('http://', adapter)
+    return transport
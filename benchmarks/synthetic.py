@@ -0,0 +1,92 @@
+"""Deterministic synthetic publishers and transactions for the benchmark servers.
+
+Every record is computed from its index, so a server can produce any page or time slice of a million transaction
+day without holding the day in memory.
+"""
+import math
+from datetime import datetime
+
+# transactions, publishers
+SCALES = {
+    '1k': (1000, 200),
+    '100k': (100000, 5000),
+    '1m': (1000000, 20000),
+}
+STATUSES = ('approved', 'declined', 'pending')
+COUNTRIES = ('DE', 'FR', 'GB', 'US', 'RU', 'AU', 'NL', 'SE')
+COUNTRY_NAMES = ('Germany', 'France', 'United Kingdom', 'United States', 'Russia', 'Australia', 'Netherlands', 'Sweden')
+DAY_SECONDS = 86400
+
+
+class Dataset:
+    """Synthetic program: publishers 1..publishers, transactions spread evenly over one day and split evenly over the statuses
+
+    Arguments:
+        transactions {int} -- Number of transactions in the day
+        publishers {int} -- Number of publishers in each network program
+
+    Keyword Arguments:
+        day {datetime} -- Day the transactions happen on (default: {2020-01-01})
+        existing {float} -- Share of the publishers that are already partners in the Impact program (default: {0.9})
+    """
+    def __init__(self, transactions, publishers, day=datetime(2020, 1, 1), existing=0.9):
+        self.transactions = transactions
+        self.publishers = publishers
+        self.day = day
+        self.existing = existing
+
+    @classmethod
+    def scale(cls, name, **kwargs):
+        transactions, publishers = SCALES[name]
+        return cls(transactions, publishers, **kwargs)
+
+    def count(self, status):
+        """Number of transactions with the status"""
+        n = STATUSES.index(status)
+        return self.transactions // 3 + (1 if n < self.transactions % 3 else 0)
+
+    def publisher(self, n):
+        """Publisher n (1 based) as {'id', 'name', 'site'}"""
+        return {'id': n, 'name': f'Publisher {n}', 'site': f'publisher{n}.example.com'}
+
+    def existing_publishers(self):
+        """IDs of the publishers that are partners in Impact before the run"""
+        return range(1, int(self.publishers * self.existing) + 1)
+
+    def second(self, status, k):
+        """Second of the day of the k-th transaction with the status"""
+        return k * DAY_SECONDS // self.count(status)
+
+    def index_range(self, status, first_second, last_second):
+        """Indices of the transactions with the status whose time falls between the two seconds of the day (inclusive)"""
+        n = self.count(status)
+        first_second = max(first_second, 0)
+        last_second = min(last_second, DAY_SECONDS - 1)
+        if n == 0 or first_second > last_second:
+            return range(0)
+        return range(math.ceil(first_second * n / DAY_SECONDS), min(n, math.ceil((last_second + 1) * n / DAY_SECONDS)))
+
+    def transaction(self, status, k):
+        """The k-th transaction with the status as a network neutral dict"""
+        i = k * 3 + STATUSES.index(status)
+        second = self.second(status, k)
+        sale = ((i * 7919) % 50000 + 100) / 100
+        return {
+            'id': 1000000000 + i,
+            'status': status,
+            'time': f'{self.day:%Y-%m-%d}T{second // 3600:02d}:{second // 60 % 60:02d}:{second % 60:02d}',
+            'publisherId': (i * 31) % self.publishers + 1,
+            'sale': sale,
+            'commission': 0 if status == 'declined' else round(sale * ((i % 20) + 1) / 100, 2),
+            'currency': 'EUR',
+            'country': i % len(COUNTRIES),
+            'mobile': i % 4 == 0,
+            'new': i % 3 == 0,
+            'voucher': f'CODE{i % 50}' if i % 5 == 0 else '',
+        }
+
+    def iter_transactions(self, status=None):
+        """Every transaction of the day, of one status or of all statuses"""
+        for s in (STATUSES if status is None else (status,)):
+            for k in range(self.count(s)):
+                yield self.transaction(s, k)
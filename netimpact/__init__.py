@@ -1,5 +1,16 @@
-import netimpact.admitad
-import netimpact.awin
-import netimpact.impact
-import netimpact.linkshare
-import netimpact.processor
\ No newline at end of file
+"""Cross affiliate network data and partner tools
+
+Submodules are imported on first attribute access, so importing netimpact (or running the CLI) does not load
+requests, pandas or the network modules until they are used.
+"""
+import importlib
+
+__version__ = '0.2.5'
+
+__all__ = ['admitad', 'awin', 'impact', 'linkshare', 'processor']
+
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module(f'{__name__}.{name}')
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,11 +1,12 @@
-import requests
-import http.client
 import mimetypes
 import json
 from urllib.parse import urlencode
 from base64 import b64encode
 from datetime import timedelta
 
+from netimpact.transport import get_transport
+from netimpact.paging import prefetch
+
 class Admitad:
     """Admitad object for interacting with the Admitad advertiser API
 
@@ -15,30 +16,47 @@ class Admitad:
 
     Keyword Arguments:
         token {str} -- If provided this string is used instead of generating a new token (default: {False})
+        transport {Transport} -- HTTP transport to send requests through. Uses the shared pooled transport if not given (default: {None})
+        page_size {int} -- Number of records requested per page of a list endpoint (default: {500})
+        metadata_cache {MetadataCache} -- Keeps the access token between runs until shortly before it expires (default: {None})
     """    
     network_name = 'Admitad'
     date_format = '%d.%m.%Y'
+    statuses = ('approved', 'declined', 'pending')
+    api_root = 'https://api.admitad.com'
+    token_scope = 'advertiser_websites advertiser_statistics advertiser_info'
+    token_margin = timedelta(minutes=5) # Cached tokens are dropped this long before they expire
 
-    def __init__(self, client_id, client_secret, token=False):    
+    def __init__(self, client_id, client_secret, token=False, transport=None, page_size=500, metadata_cache=None):    
         super().__init__()
         self.client_id = client_id
         self.client_secret = client_secret
+        self.transport = transport or get_transport()
+        self.page_size = page_size
+        self.metadata_cache = metadata_cache
         if token:
             self.headers = {'Authorization': f'Bearer {token}'}
         else:
             self.headers = {'Authorization': f'Bearer {self.get_token()}'}
 
+    @classmethod
+    def from_config(cls, config, metadata_cache=None):
+        """Create the network object from its [Admitad] config section (see README)"""
+        return cls(config['client_id'], config['client_secret'], page_size=config.get('page_size', 500), metadata_cache=metadata_cache)
+
     def get_token(self):
-        """Generate authorisation token from Admitad
+        """Generate authorisation token from Admitad, or reuse the one in the metadata cache while it is valid
 
         Returns:
             string -- Admitad access token
         """        
+        key = f'admitad:{self.client_id}:token'
+        if self.metadata_cache is not None:
+            token = self.metadata_cache.get(key)
+            if token:
+                return token
         auth = b64encode(bytes((self.client_id + ':' + self.client_secret),'utf-8'))
 
-        conn = http.client.HTTPSConnection("api.admitad.com")
-        payload = ''
-
         headers = {
         'Content-Type': 'application/x-www-form-urlencoded',
         'Authorization': f'Basic {auth.decode("utf-8")}'
@@ -46,14 +64,44 @@ class Admitad:
         data = {
             'grant_type': 'client_credentials',
             'client_id': self.client_id,
-            'scope': 'advertiser_websites advertiser_statistics advertiser_info'
+            'scope': self.token_scope
          }
         encoded_args = urlencode(data)
-        conn.request("POST", f"/token/?{encoded_args}", payload, headers)
-        res = conn.getresponse()
-        data = res.read()
-        return json.loads(data)['access_token']
+        r = self.transport.post(f"{self.api_root}/token/?{encoded_args}", headers=headers)
+        rj = r.json()
+        if self.metadata_cache is not None and rj.get('expires_in'):
+            ttl = timedelta(seconds=int(rj['expires_in'])) - self.token_margin
+            if ttl > timedelta(0):
+                self.metadata_cache.set(key, rj['access_token'], ttl)
+        return rj['access_token']
+
+
+    def iter_pages(self, path, params=None):
+        """Yield every page of a list endpoint, stepping offset by the records received until _meta.count is reached
+
+        Arguments:
+            path {string} -- Endpoint path below api_root
 
+        Keyword Arguments:
+            params {dict} -- Query parameters for every page (default: {None})
+
+        Yields:
+            list -- Records of one page
+        """
+        offset = 0
+        while True:
+            r = self.transport.get(f"{self.api_root}{path}", params={**(params or {}), 'offset': offset, 'limit': self.page_size}, headers=self.headers)
+            rj = r.json()
+            results = rj['results']
+            yield results
+            offset += len(results)
+            if not results or offset >= rj['_meta']['count']:
+                return
+
+    def iter_results(self, path, params=None):
+        """Yield every record of a list endpoint, downloading the next page while the current one is processed"""
+        for results in prefetch(self.iter_pages(path, params)):
+            yield from results
 
     def get_pubs(self, acct):
         """GET the list of websites connected to the Admitad program as publishers and extract the relevant partner information
@@ -64,14 +112,8 @@ class Admitad:
         Returns:
             list -- A list of dictionaries containing publisher name, id, and site url
         """        
-        conn = http.client.HTTPSConnection("api.admitad.com")
-        payload = ''
-        conn.request("GET", f"/advertiser/{acct}/websites/?limit=1000", payload, self.headers)
-        res = conn.getresponse()
-        data = res.read()
-        admitad_sites = json.loads(data.decode("utf-8"))['results']
         pub_list = []
-        for ap in admitad_sites:
+        for ap in self.iter_results(f"/advertiser/{acct}/websites/"):
             pub = {
                 'name': f"{ap['website']['name']} - {ap['user']['name']}",
                 'id': ap['website']['id'],
@@ -93,7 +135,7 @@ class Admitad:
 
 
         Returns:
-            dict -- Dictionary containing transaction data
+            generator -- Transaction records, fetched page by page
         """
         if status == 'pending':
             st = 0
@@ -103,32 +145,23 @@ class Admitad:
             st = 2
         else:
             st = 0
-        conn = http.client.HTTPSConnection("api.admitad.com")
-        payload = ''
-
-        
-        conn.request("GET", f"/advertiser/{acct}/statistics/actions/?start_date={start}&end_date={end}&status={st}&limit=5000", payload, self.headers)
-        res = conn.getresponse()
-        data = res.read()
-        return json.loads(data.decode("utf-8"))['results']
+        return self.iter_results(f"/advertiser/{acct}/statistics/actions/", {'start_date': start, 'end_date': end, 'status': st})
 
-    def get_all_transactions(self, acct, start, end, status):
-        """GET all transactions over the given time period with a given status and transform
-        the transactions into dictionaries consumable by the Impact transaction upload object
+    def iter_transactions(self, acct, start, end, status):
+        """Yield the transactions over the given time period with a given status as the pages come in, transformed into
+        dictionaries consumable by the Impact transaction upload object
         TODO :: Add flexibility for the identifier of new vs returning and device type
 
         Arguments:
             acct {string} -- Admitad account ID
-            start {datetime} -- Datetime object for the beginning of the transaction time period
-            end {datetime} -- Datetime object for the end of the transaction time period
+            start {string} -- Beginning of the transaction time period, formatted by date_formatter or window_formatter
+            end {string} -- End of the transaction time period, formatted by date_formatter or window_formatter
             status {string} -- Status of the transactions to be pulled - one of [pending, approved, declined]. Defaults to pending if incorrect input is given.
 
-        Returns:
-            list -- List of dictionaries containing transaction data
-        """        
-        transactions = self.transaction_request(acct,start,end,status)
-        transaction_list = []
-        for t in transactions:
+        Yields:
+            tuple -- (status, transaction dictionary)
+        """
+        for t in self.transaction_request(acct,start,end,status):
             try:
                 if t['product_id'] == 1636:
                     nvr = 'New'
@@ -152,15 +185,27 @@ class Admitad:
                     transaction['device'] = 'Mobile'
                 else:
                     transaction['device'] = 'Desktop'
-                transaction_list.append(transaction)
             except TypeError as e:
                 transaction['device'] = 'Desktop'
-        return transaction_list
+                continue
+            yield status, transaction
+
+    def get_all_transactions(self, acct, start, end, status):
+        """GET all transactions over the given time period with a given status (see iter_transactions)
+
+        Returns:
+            list -- List of dictionaries containing transaction data
+        """
+        return [t for _, t in self.iter_transactions(acct, start, end, status)]
 
     def date_formatter(self, target_date, target_start_date=False):
         if target_start_date:
-            pass
+            start = (target_start_date - timedelta(1)).strftime(self.date_format)
         else:
             start = (target_date - timedelta(1)).strftime(self.date_format)
         end = target_date.strftime(self.date_format)
-        return start, end
\ No newline at end of file
+        return start, end
+
+    def window_formatter(self, start, end):
+        """Format an arbitrary time window. The API only filters by day, so the whole days the window touches are requested"""
+        return start.strftime(self.date_format), end.strftime(self.date_format)
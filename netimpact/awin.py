@@ -1,20 +1,36 @@
 #!/usr/bin/env python3
-import requests
+from netimpact.transport import get_transport
+from netimpact.paging import prefetch
 import logging
 import time
 from datetime import timedelta, datetime
+from urllib.parse import quote
 
 class AWin:
     """AWin object for interacting with the AWin advertiser API
 
     Arguments:
         token {string} -- AWin API auth token
+
+    Keyword Arguments:
+        transport {Transport} -- HTTP transport to send requests through. Uses the shared pooled transport if not given (default: {None})
+        slice_hours {int} -- Length of the time slices a transaction period is requested in. The transactions API has no pages,
+                             so each slice is one page (default: {24})
     """    
     network_name = 'Awin'
     date_format = '%Y-%m-%d'
+    datetime_format = '%Y-%m-%dT%H:%M:%S'
+    statuses = ('approved', 'declined', 'pending')
 
-    def __init__(self, token):    
+    def __init__(self, token, transport=None, slice_hours=24):    
         self.token = token
+        self.transport = transport or get_transport()
+        self.slice_hours = slice_hours
+
+    @classmethod
+    def from_config(cls, config, metadata_cache=None):
+        """Create the network object from its [Awin] config section (see README)"""
+        return cls(config['oauth'], slice_hours=config.get('slice_hours', 24))
 
     def get_pubs(self, acct):
         """GET the list of websites connected to the Awin program as publishers and extract the relevant partner information
@@ -26,56 +42,73 @@ class AWin:
             list -- A list of dictionaries containing publisher name, id, and site url
         """         
         url = f"https://api.awin.com/advertisers/{acct}/publishers?&accessToken={self.token}"
-        r = requests.get(url)
-        while r.status_code == 429:
-            time.sleep(60)
-            r = requests.get(url)
+        r = self.transport.get(url)
         pub_list = r.json()
         for p in pub_list:
             p['site'] = 'https://www.awinpub.com'
         return pub_list
 
+    def time_slices(self, start, end):
+        """Split a formatted period into consecutive slice_hours long periods covering every second of it
+
+        Arguments:
+            start {string} -- Beginning of the period, formatted with datetime_format
+            end {string} -- End of the period (inclusive), formatted with datetime_format
+
+        Returns:
+            list -- (start, end) formatted string tuples
+        """
+        start = datetime.strptime(start, self.datetime_format)
+        end = datetime.strptime(end, self.datetime_format)
+        step = timedelta(hours=self.slice_hours)
+        slices = []
+        while start <= end:
+            slice_end = min(start + step - timedelta(seconds=1), end)
+            slices.append((start.strftime(self.datetime_format), slice_end.strftime(self.datetime_format)))
+            start = slice_end + timedelta(seconds=1)
+        return slices
+
+    def iter_pages(self, acct, start, end, status):
+        """Yield the transactions of each time slice of the period (see time_slices) as one page"""
+        for slice_start, slice_end in self.time_slices(start, end):
+            url = f"https://api.awin.com/advertisers/{acct}/transactions/?startDate={quote(slice_start)}&endDate={quote(slice_end)}&timezone=GMT&accessToken={self.token}&status={status}"
+            if status == 'approved' or status == 'declined':
+                url += '&dateType=validation'
+            r = self.transport.get(url)
+            yield r.json()
+
     def transaction_request(self, acct, start, end, status):
         """GET all transactions over the given time period with a given status and transform
         the transactions into dictionaries consumable by the Impact transaction upload object
 
         Arguments:
             acct {string} -- Awin account ID
-            start {datetime} -- Datetime object for the beginning of the transaction time period
-            end {datetime} -- Datetime object for the end of the transaction time period
+            start {string} -- Beginning of the transaction time period, formatted by date_formatter or window_formatter
+            end {string} -- End of the transaction time period, formatted by date_formatter or window_formatter
             status {string} -- Status of the transactions to be pulled - one of [pending, approved, declined]. Defaults to pending if incorrect input is given.
 
 
         Returns:
-            dict -- Dictionary containing transaction data
+            generator -- Transaction records, fetched slice by slice with the next slice downloading while the current one is processed
         """
-        url = f"https://api.awin.com/advertisers/{acct}/transactions/?startDate={start}T00%3A00%3A00&endDate={end}T23%3A59%3A59&timezone=GMT&accessToken={self.token}&status={status}"
-        if status == 'approved' or status == 'declined':
-            url += '&dateType=validation'
-        r = requests.get(url)
-        while r.status_code == 429:
-            time.sleep(60)
-            r = requests.get(url)
-        return r.json()
+        for page in prefetch(self.iter_pages(acct, start, end, status)):
+            yield from page
 
-    def get_all_transactions(self, acct, start, end, status):
-        """GET all transactions over the given time period with a given status and transform
-        the transactions into dictionaries consumable by the Impact transaction upload object
+    def iter_transactions(self, acct, start, end, status):
+        """Yield the transactions over the given time period with a given status as they are fetched, transformed into
+        dictionaries consumable by the Impact transaction upload object
         TODO :: Add flexibility for the identifier of new vs returning and device type
 
         Arguments:
             acct {string} -- Awin account ID
-            start {datetime} -- Datetime object for the beginning of the transaction time period
-            end {datetime} -- Datetime object for the end of the transaction time period
+            start {string} -- Beginning of the transaction time period, formatted by date_formatter or window_formatter
+            end {string} -- End of the transaction time period, formatted by date_formatter or window_formatter
             status {string} -- Status of the transactions to be pulled - one of [pending, approved, declined]. Defaults to pending if incorrect input is given.
 
-
-        Returns:
-            list -- List of dictionaries containing transaction data
-        """     
-
-        transaction_list = self.transaction_request(acct, start, end, status)
-        for t in transaction_list:
+        Yields:
+            tuple -- (status, transaction dictionary)
+        """
+        for t in self.transaction_request(acct, start, end, status):
             if status == 'pending':
                 try:
                     for cg in t['transactionParts']:
@@ -90,8 +123,15 @@ class AWin:
                 t['device'] = 'Mobile'
             else:
                 t['device'] = 'Desktop'
+            yield status, t
 
-        return transaction_list
+    def get_all_transactions(self, acct, start, end, status):
+        """GET all transactions over the given time period with a given status (see iter_transactions)
+
+        Returns:
+            list -- List of dictionaries containing transaction data
+        """
+        return [t for _, t in self.iter_transactions(acct, start, end, status)]
 
     def get_agg_transactions(self, acct, start, end):
         url = f"https://api.awin.com/advertisers/{acct}/reports/publisher?startDate={start}&endDate={end}&timezone=GMT&accessToken={self.token}"
@@ -99,8 +139,12 @@ class AWin:
 
     def date_formatter(self, target_date, target_start_date=False):
         if target_start_date:
-            pass
+            start = (target_start_date).strftime(self.date_format)
         else:
             start = (target_date).strftime(self.date_format)
         end = (target_date).strftime(self.date_format)
-        return start, end
\ No newline at end of file
+        return f'{start}T00:00:00', f'{end}T23:59:59'
+
+    def window_formatter(self, start, end):
+        """Format an arbitrary GMT time window, the transactions API accepts times to the second"""
+        return start.strftime(self.datetime_format), end.strftime(self.datetime_format)
\ No newline at end of file
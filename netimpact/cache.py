@@ -0,0 +1,225 @@
+import json
+import logging
+import os
+import sqlite3
+from contextlib import closing
+from datetime import datetime, timedelta
+
+
+class PartnerCache:
+    """On-disk SQLite store of the Impact partner map (MPValue1 -> Impact partner ID) so runs do not have to page
+    through the full MediaPartners list on start up.
+
+    The Impact MediaPartners list is ordered by creation, so an incremental sync only re-reads the last page seen on
+    the previous sync and everything after it. Changes to existing partners are picked up by the full rebuild, which
+    happens on demand or once the last full sync is older than max_age.
+
+    The map and its sync position belong to a single Impact account and program, so each program needs its own database.
+
+    Arguments:
+        path {string} -- Filepath of the SQLite database
+
+    Keyword Arguments:
+        max_age {timedelta} -- Age of the last full sync after which the map is rebuilt from scratch (default: {24 hours})
+    """
+    def __init__(self, path, max_age=timedelta(hours=24)):
+        self.path = path
+        self.max_age = max_age
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with closing(sqlite3.connect(self.path)) as conn, conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS partners (mpvalue1 TEXT PRIMARY KEY, partner_id TEXT NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+    def load(self):
+        """Read the stored partner map
+
+        Returns:
+            dict -- {Network Partner ID : Impact Partner ID}
+        """
+        with closing(sqlite3.connect(self.path)) as conn:
+            return dict(conn.execute('SELECT mpvalue1, partner_id FROM partners'))
+
+    def get_meta(self, key, default=None):
+        with closing(sqlite3.connect(self.path)) as conn:
+            row = conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def is_stale(self):
+        """True if the map has never been fully synced or the last full sync is older than max_age"""
+        full_sync_at = self.get_meta('full_sync_at')
+        if full_sync_at is None:
+            return True
+        return datetime.now() - datetime.fromisoformat(full_sync_at) > self.max_age
+
+    def store(self, partners, last_page, full=False):
+        """Upsert partners into the map and record the sync position
+
+        Arguments:
+            partners {dict} -- {Network Partner ID : Impact Partner ID}
+            last_page {int} -- Last MediaPartners page read during the sync
+
+        Keyword Arguments:
+            full {bool} -- Replace the whole map instead of merging into it (default: {False})
+        """
+        now = datetime.now().isoformat()
+        with closing(sqlite3.connect(self.path, timeout=30)) as conn, conn:
+            if full:
+                conn.execute('DELETE FROM partners')
+                conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('full_sync_at', now))
+            conn.executemany('INSERT OR REPLACE INTO partners VALUES (?, ?)', partners.items())
+            conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('last_page', str(last_page)))
+            conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('synced_at', now))
+
+    def merge(self, partners):
+        """Upsert partners learnt outside a sync (e.g. from partner creation responses) without moving the sync position
+
+        Arguments:
+            partners {dict} -- {Network Partner ID : Impact Partner ID}
+        """
+        with closing(sqlite3.connect(self.path, timeout=30)) as conn, conn:
+            conn.executemany('INSERT OR REPLACE INTO partners VALUES (?, ?)', partners.items())
+
+    def sync(self, impact, full=False):
+        """Bring the stored map up to date with the Impact program and return it
+
+        Arguments:
+            impact {object} -- Impact object used to page through the MediaPartners list
+
+        Keyword Arguments:
+            full {bool} -- Force a full rebuild of the map (default: {False})
+
+        Returns:
+            dict -- {Network Partner ID : Impact Partner ID}
+        """
+        if full or self.is_stale():
+            logging.info(f'Rebuilding partner cache {self.path}')
+            partners, last_page = impact.get_partner_pages()
+            self.store(partners, last_page, full=True)
+            return partners
+        start_page = int(self.get_meta('last_page', 1))
+        logging.info(f'Refreshing partner cache {self.path} from page {start_page}')
+        partners, last_page = impact.get_partner_pages(start_page)
+        self.store(partners, last_page)
+        return self.load()
+
+
+class GroupMembershipCache:
+    """On-disk SQLite index of the partners in each MediaPartnerGroups group, so add_to_group only sends partners that
+    are not in the group yet.
+
+    Partners added by netimpact are recorded as their group update succeeds. Changes made in Impact itself are picked up
+    when a group's membership is re-read in full, on demand or once it is older than max_age.
+
+    Arguments:
+        path {string} -- Filepath of the SQLite database
+
+    Keyword Arguments:
+        max_age {timedelta} -- Age of a group's last full read after which it is read again (default: {24 hours})
+    """
+    def __init__(self, path, max_age=timedelta(hours=24)):
+        self.path = path
+        self.max_age = max_age
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with closing(sqlite3.connect(self.path)) as conn, conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS group_members (group_id TEXT, partner_id TEXT, PRIMARY KEY (group_id, partner_id))')
+            conn.execute('CREATE TABLE IF NOT EXISTS group_syncs (group_id TEXT PRIMARY KEY, synced_at TEXT)')
+
+    def load(self, group_id):
+        with closing(sqlite3.connect(self.path)) as conn:
+            return {p for (p,) in conn.execute('SELECT partner_id FROM group_members WHERE group_id = ?', (str(group_id),))}
+
+    def is_stale(self, group_id):
+        with closing(sqlite3.connect(self.path)) as conn:
+            row = conn.execute('SELECT synced_at FROM group_syncs WHERE group_id = ?', (str(group_id),)).fetchone()
+        return row is None or datetime.now() - datetime.fromisoformat(row[0]) > self.max_age
+
+    def store(self, group_id, partner_ids, full=False):
+        """Record partners as members of the group
+
+        Arguments:
+            group_id {string} -- Group ID
+            partner_ids {iterable} -- Impact partner IDs
+
+        Keyword Arguments:
+            full {bool} -- Replace the group's membership and restart its max_age (default: {False})
+        """
+        group_id = str(group_id)
+        with closing(sqlite3.connect(self.path, timeout=30)) as conn, conn:
+            if full:
+                conn.execute('DELETE FROM group_members WHERE group_id = ?', (group_id,))
+                conn.execute('INSERT OR REPLACE INTO group_syncs VALUES (?, ?)', (group_id, datetime.now().isoformat()))
+            conn.executemany('INSERT OR IGNORE INTO group_members VALUES (?, ?)', [(group_id, str(p)) for p in partner_ids])
+
+    def sync(self, impact, group_id, full=False):
+        """Members of the group, read from Impact if the stored membership is stale
+
+        Arguments:
+            impact {object} -- Impact object used to read the group
+            group_id {string} -- Group ID
+
+        Keyword Arguments:
+            full {bool} -- Force a full read of the group (default: {False})
+
+        Returns:
+            set -- Impact partner IDs
+        """
+        if full or self.is_stale(group_id):
+            logging.info(f'Reading members of group {group_id}')
+            members = impact.get_group_members(group_id)
+            self.store(group_id, members, full=True)
+            return set(members)
+        return self.load(group_id)
+
+
+class MetadataCache:
+    """On-disk SQLite store of small JSON metadata items (contract ID, group list, auth tokens) that each expire after their own TTL,
+    so runs can skip the round trips that fetch them on start up
+
+    Arguments:
+        path {string} -- Filepath of the SQLite database
+    """
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with closing(sqlite3.connect(self.path)) as conn, conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT, expires_at TEXT)')
+
+    def get(self, key):
+        """Stored value of an item, None if it is missing or expired"""
+        with closing(sqlite3.connect(self.path)) as conn:
+            row = conn.execute('SELECT value, expires_at FROM metadata WHERE key = ?', (key,)).fetchone()
+        if row is None or datetime.now() >= datetime.fromisoformat(row[1]):
+            return None
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl):
+        """Store a JSON serialisable value that expires after ttl (timedelta)"""
+        with closing(sqlite3.connect(self.path, timeout=30)) as conn, conn:
+            conn.execute('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?)', (key, json.dumps(value), (datetime.now() + ttl).isoformat()))
+
+    def invalidate(self, key):
+        with closing(sqlite3.connect(self.path, timeout=30)) as conn, conn:
+            conn.execute('DELETE FROM metadata WHERE key = ?', (key,))
+
+    def get_or_load(self, key, loader, ttl):
+        """Stored value of an item, or the loader's result stored for ttl if it is missing or expired
+
+        Arguments:
+            key {string} -- Item key
+            loader {function} -- Called without arguments to fetch the value
+            ttl {timedelta} -- How long a loaded value is kept
+
+        Returns:
+            object -- Item value
+        """
+        value = self.get(key)
+        if value is None:
+            value = loader()
+            self.set(key, value, ttl)
+        return value
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+import threading
+from collections import deque
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+# Query parameters holding credentials, stored as REDACTED. URL userinfo (the Impact SID and token) is dropped.
+SECRET_PARAMS = ('accessToken', 'access_token', 'token', 'client_secret', 'Password')
+# Fields of JSON response bodies holding credentials (e.g. the Admitad /token/ response), stored as REDACTED
+SECRET_FIELDS = ('access_token', 'refresh_token', 'id_token', 'client_secret', 'password', 'Password')
+# The recorded body is stored decoded and whole, so these no longer describe it
+DROPPED_HEADERS = ('Content-Encoding', 'Content-Length', 'Transfer-Encoding', 'Set-Cookie')
+
+
+class CassetteMiss(LookupError):
+    """A replayed request has no recorded response"""
+
+
+class Cassette:
+    """Recording of the HTTP requests and responses of a run, made by the transport in record mode and served back
+    by it in replay mode without network access or rate limiting.
+
+    A cassette directory holds requests.jsonl, one line per request in the order the responses arrived, and the
+    response bodies under bodies/. Credentials are left out of the recorded URLs and JSON response bodies (see SECRET_PARAMS
+    and SECRET_FIELDS), the rest of the bodies, account and partner data included, is stored as received.
+    In replay mode every recorded response is served once: to the same request if there is one, otherwise to the next
+    request for the same method, host and path, so runs whose time windows moved (--incremental) still replay.
+    Once they are used up, the last response to the same request is served again.
+
+    Arguments:
+        path {string} -- Cassette directory
+        mode {string} -- One of record, replay
+    """
+    def __init__(self, path, mode):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f'Unknown cassette mode {mode}, expected record or replay')
+        self.path = path
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.index_path = os.path.join(path, 'requests.jsonl')
+        self.bodies_path = os.path.join(path, 'bodies')
+        if mode == 'record':
+            os.makedirs(self.bodies_path, exist_ok=True)
+            self.count = 0
+            self.index = open(self.index_path, 'w')
+        else:
+            self.by_key = {}
+            self.by_route = {}
+            self.last = {}
+            with open(self.index_path) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    entry['served'] = False
+                    self.by_key.setdefault(entry['key'], deque()).append(entry)
+                    self.by_route.setdefault(self.route(entry['method'], entry['url']), deque()).append(entry)
+
+    @property
+    def replaying(self):
+        return self.mode == 'replay'
+
+    def redact(self, url):
+        """URL without userinfo and with the credential query parameters replaced"""
+        parts = urlsplit(url)
+        query = [(k, 'REDACTED' if k in SECRET_PARAMS else v) for k, v in parse_qsl(parts.query, keep_blank_values=True)]
+        return urlunsplit((parts.scheme, parts.hostname + (f':{parts.port}' if parts.port else ''), parts.path, urlencode(query), ''))
+
+    def key(self, method, url, params=None, data=None, json=None, **kwargs):
+        """Request key: method, redacted URL with the query parameters, and a hash of the body if there is one
+
+        Returns:
+            tuple -- (key, redacted URL)
+        """
+        prepared = requests.Request(method, url, params=params, data=data, json=json).prepare()
+        redacted = self.redact(prepared.url)
+        key = f'{method} {redacted}'
+        if prepared.body:
+            body = prepared.body if isinstance(prepared.body, bytes) else prepared.body.encode()
+            key += f' {hashlib.sha1(body).hexdigest()}'
+        return key, redacted
+
+    def route(self, method, url):
+        parts = urlsplit(url)
+        return method, parts.hostname, parts.path
+
+    def record(self, method, url, r, **kwargs):
+        """Store a response. A streamed response is read whole first, the caller can still iterate over it.
+
+        Arguments:
+            method {string} -- HTTP method
+            url {string} -- Request URL
+            r {requests.response} -- Response to the request
+        """
+        key, redacted = self.key(method, url, **kwargs)
+        body = redact_body(r.content)
+        headers = {k: v for k, v in r.headers.items() if k not in DROPPED_HEADERS}
+        with self.lock:
+            self.count += 1
+            name = f'{self.count:06d}.bin'
+            with open(os.path.join(self.bodies_path, name), 'wb') as f:
+                f.write(body)
+            entry = {'key': key, 'method': method, 'url': redacted, 'status': r.status_code, 'reason': r.reason, 'headers': headers, 'body': name}
+            self.index.write(json.dumps(entry) + '\n')
+            self.index.flush()
+
+    def replay(self, method, url, **kwargs):
+        """Recorded response to a request
+
+        Arguments:
+            method {string} -- HTTP method
+            url {string} -- Request URL
+
+        Returns:
+            requests.response -- Recorded response
+
+        Raises:
+            CassetteMiss -- Nothing was recorded for the request, or for its method, host and path
+        """
+        key, redacted = self.key(method, url, **kwargs)
+        with self.lock:
+            entry = self.next_unserved(self.by_key.get(key)) or self.next_unserved(self.by_route.get(self.route(method, redacted)))
+            if entry is not None:
+                entry['served'] = True
+                self.last[key] = entry
+            else:
+                entry = self.last.get(key)
+        if entry is None:
+            raise CassetteMiss(f'No recorded response for {method} {redacted} in {self.path}')
+        with open(os.path.join(self.bodies_path, entry['body']), 'rb') as f:
+            body = f.read()
+        r = requests.Response()
+        r.status_code = entry['status']
+        r.reason = entry['reason']
+        r.headers = CaseInsensitiveDict(entry['headers'])
+        r.encoding = get_encoding_from_headers(r.headers)
+        r.url = url
+        r._content = body
+        r._content_consumed = True
+        return r
+
+    def next_unserved(self, entries):
+        while entries and entries[0]['served']:
+            entries.popleft()
+        return entries[0] if entries else None
+
+    def close(self):
+        if self.mode == 'record':
+            self.index.close()
+
+
+def redact_body(body):
+    """Response body with the SECRET_FIELDS of a JSON body replaced, other bodies are returned unchanged"""
+    if not any(field.encode() in body for field in SECRET_FIELDS):
+        return body
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return body
+    return json.dumps(redact_fields(data)).encode()
+
+
+def redact_fields(data):
+    if isinstance(data, dict):
+        return {k: 'REDACTED' if k in SECRET_FIELDS else redact_fields(v) for k, v in data.items()}
+    if isinstance(data, list):
+        return [redact_fields(v) for v in data]
+    return data
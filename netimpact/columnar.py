@@ -0,0 +1,129 @@
+import logging
+from datetime import datetime
+from itertools import repeat
+
+import numpy as np
+import pandas as pd
+
+from netimpact.processor import NEW_TRANSACTION_HEADERS, MODIFIED_TRANSACTION_HEADERS
+
+
+def transaction_frame(transactions):
+    """Flatten a batch of network transaction dicts into a DataFrame with one column per field.
+    Columns keep the original Python objects (object dtype) so values are written out exactly as the row engine writes them.
+
+    Arguments:
+        transactions {list} -- list of transaction dicts
+
+    Returns:
+        pandas.DataFrame -- One row per transaction
+    """
+    columns = {
+        'transactionDate': [t['transactionDate'] for t in transactions],
+        'id': [t['id'] for t in transactions],
+        'publisherId': [t['publisherId'] for t in transactions],
+        'status': [t['status'] for t in transactions],
+        'saleAmount': [t['saleAmount']['amount'] for t in transactions],
+        'currency': [t['saleAmount']['currency'] for t in transactions],
+        'commissionAmount': [t['commissionAmount']['amount'] for t in transactions],
+        'voucherCode': [t['voucherCode'] for t in transactions],
+        'customerCountry': [t['customerCountry'] for t in transactions],
+        'advertiserCountry': [t['advertiserCountry'] for t in transactions],
+        'device': [t['device'] for t in transactions],
+    }
+    return pd.DataFrame({k: pd.Series(v, dtype=object) for k,v in columns.items()})
+
+def action_tracker_ids(impact, device):
+    return device.map({'Desktop': impact.desktop_action_tracker_id, 'Mobile': impact.mobile_action_tracker_id})
+
+def commission_rates(commission, sale):
+    """Whole percentage commission rate, matching int(round(commission / sale, 2) * 100) row by row (0 when the sale amount is 0).
+    Ratios sitting on a rounding boundary, where numpy and Python rounding can disagree, are rounded with Python's round.
+
+    Arguments:
+        commission {pandas.Series} -- Commission amounts
+        sale {pandas.Series} -- Sale amounts
+
+    Returns:
+        pandas.Series -- Integer commission rates
+    """
+    commission = commission.astype(float)
+    sale = sale.astype(float)
+    zero_sale = sale == 0
+    ratio = (commission / sale.mask(zero_sale, 1)).mask(zero_sale, 0.0)
+    rounded = ratio.round(2)
+    scaled = ratio * 100
+    boundary = (scaled - np.floor(scaled) - 0.5).abs() < 1e-6
+    if boundary.any():
+        rounded[boundary] = ratio[boundary].map(lambda r: round(r, 2))
+    return (rounded * 100).astype(int)
+
+def new_transaction_lists(impact, t_lists, account_name, network_name):
+    """Columnar version of processor.new_transaction_lists producing the same rows with batched column operations
+
+    Arguments:
+        t_lists {list} -- lists of transaction dicts
+        account_name {string} -- Network program/account name
+        network_name {string} -- Network name
+
+    Returns:
+        tuple -- (list of Impact conversions upload headers, list of conversion rows)
+    """
+    df = transaction_frame([t for l in t_lists for t in l])
+    if df.empty:
+        return NEW_TRANSACTION_HEADERS, []
+    mpid = df['publisherId'].astype(str).map(impact.existing_partner_dict)
+    missing = mpid.isna()
+    for publisher_id, transaction_id in df.loc[missing, ['publisherId', 'id']].itertuples(index=False, name=None):
+        logging.warning(f'No valid partner {publisher_id} found for {network_name} transaction {transaction_id}')
+    df = df[~missing]
+    mpid = mpid[~missing]
+    modified = f'{datetime.now():%Y-%m-%dT%H:%M:%S}'
+    n = len(df)
+    transaction_date = df['transactionDate'].tolist()
+    customer_country = df['customerCountry'].tolist()
+    columns = [
+        repeat(impact.program_id, n),
+        action_tracker_ids(impact, df['device']).tolist(),
+        transaction_date,
+        df['id'].tolist(),
+        mpid.tolist(),
+        df['status'].tolist(),
+        df['currency'].tolist(),
+        df['saleAmount'].tolist(),
+        repeat('cat', n),
+        repeat('sku', n),
+        repeat(1, n),
+        repeat(account_name, n),
+        repeat(account_name, n),
+        customer_country,
+        customer_country,
+        df['advertiserCountry'].tolist(),
+        transaction_date,
+        repeat(account_name, n),
+        commission_rates(df['commissionAmount'], df['saleAmount']).tolist(),
+        repeat('pending', n),
+        df['voucherCode'].tolist(),
+        repeat(modified, n),
+    ]
+    return NEW_TRANSACTION_HEADERS, list(zip(*columns))
+
+def modified_transaction_lists(impact, approved, declined):
+    """Columnar version of processor.modified_transaction_lists producing the same rows with batched column operations
+
+    Arguments:
+        approved {list} -- List of approved transactions (dictionaries)
+        declined {list} -- List of declined/reversed transactions (dictionaries)
+
+    Returns:
+        tuple -- (Impact modification file headers, list of modification rows)
+    """
+    rows = []
+    for transactions, reason in ((approved, 'VALIDATED_ORDER'), (declined, 'RETURNED')):
+        df = transaction_frame(transactions)
+        if df.empty:
+            continue
+        n = len(df)
+        amount = df['saleAmount'].tolist() if reason == 'VALIDATED_ORDER' else repeat(0, n)
+        rows.extend(zip(action_tracker_ids(impact, df['device']).tolist(), df['id'].tolist(), amount, repeat(reason, n)))
+    return MODIFIED_TRANSACTION_HEADERS, rows
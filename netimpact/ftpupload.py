@@ -0,0 +1,155 @@
+import ftplib
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+class IncompleteUpload(ftplib.Error):
+    """The server holds a different number of bytes than the uploaded file after the transfer"""
+
+
+class FTPUploader:
+    """Uploads batch files to the Impact batch FTP over a small pool of logged in sessions that is kept for the whole run.
+    Files are uploaded in parallel, one per session. Each file is written to a .part name and renamed once the server holds
+    all of its bytes (where the server supports SIZE), so Impact never picks up a partial batch. A failed transfer is retried with backoff and resumed with REST
+    from the size of the .part file it left. Point host and port at a local FTP server (pyftpdlib) to run it without Impact.
+
+    Arguments:
+        username {string} -- Impact program FTP username
+        password {string} -- Impact program FTP password
+
+    Keyword Arguments:
+        host {string} -- FTP host (default: {'batch.impactradius.com'})
+        port {int} -- FTP port (default: {21})
+        sessions {int} -- Maximum number of sessions open at the same time (default: {2})
+        retries {int} -- Number of times a failed file is retried (default: {3})
+        retry_delay {float} -- Seconds before the first retry, doubled on every further retry (default: {30})
+        timeout {float} -- Socket timeout in seconds (default: {60})
+    """
+    def __init__(self, username, password, host='batch.impactradius.com', port=21, sessions=2, retries=3, retry_delay=30, timeout=60):
+        self.username = username
+        self.password = password
+        self.host = host
+        self.port = port
+        self.sessions = sessions
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(sessions)
+
+    def connect(self):
+        ftp = ftplib.FTP(timeout=self.timeout)
+        ftp.connect(self.host, self.port)
+        ftp.login(self.username, self.password)
+        return ftp
+
+    @contextmanager
+    def session(self):
+        """Borrow a logged in session from the pool, opening a new one if no idle session is still alive.
+        Sessions that fail while borrowed are closed instead of going back to the pool."""
+        with self.slots:
+            ftp = None
+            while ftp is None and not self.idle.empty():
+                ftp = self.idle.get_nowait()
+                try:
+                    ftp.voidcmd('NOOP')
+                except (ftplib.all_errors) as e:
+                    ftp.close()
+                    ftp = None
+            if ftp is None:
+                ftp = self.connect()
+            try:
+                yield ftp
+            except BaseException:
+                ftp.close()
+                raise
+            self.idle.put(ftp)
+
+    def remote_size(self, ftp, name):
+        """Size of a remote file, None if it does not exist or the server does not support SIZE"""
+        try:
+            ftp.voidcmd('TYPE I')
+            return ftp.size(name)
+        except ftplib.error_perm:
+            return None
+
+    def delete(self, ftp, name):
+        """Delete a remote file if it exists"""
+        try:
+            ftp.delete(name)
+        except ftplib.error_perm:
+            pass
+
+    def upload(self, path):
+        """Upload a single file under a .part name, retrying and resuming partial transfers, and rename it once it is complete.
+        The local file is removed once it is uploaded.
+
+        Arguments:
+            path {Path} -- Local file path
+
+        Returns:
+            bool -- True if the file was uploaded
+        """
+        name = os.path.basename(path)
+        part = name + '.part'
+        size = os.path.getsize(path)
+        for attempt in range(self.retries + 1):
+            try:
+                with self.session() as ftp, open(path, 'rb') as file:
+                    # Only resume retries from the .part file they left - one from an earlier run may hold another batch
+                    offset = (self.remote_size(ftp, part) or 0) if attempt > 0 else 0
+                    if offset > size:
+                        offset = 0
+                    if offset:
+                        logging.info(f'Resuming {name} from byte {offset}/{size}')
+                    else:
+                        self.delete(ftp, part)
+                    file.seek(offset)
+                    ftp.storbinary(f'STOR {part}', file, rest=offset or None)
+                    # Servers without SIZE cannot be checked (nor resumed), the transfer is trusted as on a plain STOR
+                    uploaded = self.remote_size(ftp, part)
+                    if uploaded is not None and uploaded != size:
+                        raise IncompleteUpload(f'{part} is {uploaded} bytes on the server, expected {size}')
+                    try:
+                        ftp.rename(part, name)
+                    except ftplib.error_perm:
+                        # Servers that do not rename over an existing file, e.g. a batch of the same name from an earlier run
+                        self.delete(ftp, name)
+                        ftp.rename(part, name)
+                logging.info(f'{path} transactions batch uploaded.')
+                os.remove(path)
+                return True
+            except ftplib.all_errors as e:
+                if attempt == self.retries:
+                    logging.error(f'FTP Upload error for {path} after {attempt + 1} attempts: {e}')
+                    return False
+                delay = self.retry_delay * 2 ** attempt
+                logging.warning(f'FTP Upload error for {path}: {e}. Retrying in {delay}s')
+                time.sleep(delay)
+
+    def upload_all(self, paths):
+        """Upload files in parallel over the session pool
+
+        Arguments:
+            paths {list} -- Local file paths
+
+        Returns:
+            list -- Paths of the files that could not be uploaded
+        """
+        paths = list(paths)
+        with ThreadPoolExecutor(self.sessions) as pool:
+            uploaded = list(pool.map(self.upload, paths))
+        return [p for p, u in zip(paths, uploaded) if not u]
+
+    def close(self):
+        while not self.idle.empty():
+            ftp = self.idle.get_nowait()
+            try:
+                ftp.quit()
+            except ftplib.all_errors:
+                ftp.close()
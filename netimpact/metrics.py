@@ -0,0 +1,158 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# name -> (Prometheus type, help text)
+METRICS = {
+    'netimpact_stage_duration_seconds': ('gauge', 'Wall time of the run stage, summed over its runs (one per backfill day)'),
+    'netimpact_stage_success': ('gauge', '1 if every run of the stage finished without an error, 0 if one failed'),
+    'netimpact_stage_failures_total': ('counter', 'Runs of the stage that failed'),
+    'netimpact_http_requests_total': ('counter', 'HTTP requests sent, retries included, by host and response code'),
+    'netimpact_http_request_seconds_total': ('counter', 'Time spent waiting for HTTP responses'),
+    'netimpact_http_response_bytes_total': ('counter', 'Response body bytes received'),
+    'netimpact_http_throttled_total': ('counter', 'Throttled responses (429, 503, 520) by host and response code'),
+    'netimpact_rate_limit_sleep_seconds_total': ('counter', 'Time spent sleeping in the rate limiter, Retry-After and backoff included'),
+    'netimpact_rows_total': ('counter', 'Rows read from the network (direction="in") and written to the batch files (direction="out")'),
+    'netimpact_partners_total': ('counter', 'Network publishers processed and Impact partners created'),
+    'netimpact_run_duration_seconds': ('gauge', 'Wall time of the run'),
+    'netimpact_run_success': ('gauge', '1 if the run finished without an error, 0 if it failed'),
+    'netimpact_run_timestamp_seconds': ('gauge', 'Unix time the run finished at'),
+}
+
+
+class RunMetrics:
+    """Thread safe counters and stage timings for a single run, written out as a Prometheus textfile collector file and a JSON run report.
+    The transport records the HTTP metrics of every request, the CLI and the processor record stages, rows and partners.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.values = {} # (metric name, sorted label tuple) -> value
+        self.stages = [] # Stage records in the order they finished
+
+    def inc(self, name, value=1, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            self.values[key] = value
+
+    @contextmanager
+    def stage(self, stage, **labels):
+        """Time the enclosed block as a run stage. Exceptions are recorded as a failed stage and raised again.
+        A stage run more than once under the same labels (once per backfill day) adds up its durations and failures,
+        and is only successful if every run was.
+
+        Arguments:
+            stage {string} -- Stage name, e.g. partners, transactions, impact_upload
+        """
+        start = time.monotonic()
+        success = False
+        try:
+            yield
+            success = True
+        finally:
+            seconds = time.monotonic() - start
+            self.inc('netimpact_stage_duration_seconds', seconds, stage=stage, **labels)
+            if not success:
+                self.inc('netimpact_stage_failures_total', stage=stage, **labels)
+            key = metric_key('netimpact_stage_success', dict(stage=stage, **labels))
+            with self.lock:
+                self.values[key] = min(self.values.get(key, 1), int(success))
+                self.stages.append({'stage': stage, **labels, 'seconds': round(seconds, 3), 'success': success})
+
+    def request(self, host, status_code, seconds, sleep):
+        """Record a single HTTP request
+
+        Arguments:
+            host {string} -- Request host
+            status_code {int} -- Response status code
+            seconds {float} -- Time until the response headers arrived
+            sleep {float} -- Time the rate limiter slept before sending it
+        """
+        self.inc('netimpact_http_requests_total', host=host, code=status_code)
+        self.inc('netimpact_http_request_seconds_total', seconds, host=host)
+        if sleep:
+            self.inc('netimpact_rate_limit_sleep_seconds_total', sleep, host=host)
+
+    def throttled(self, host, status_code):
+        self.inc('netimpact_http_throttled_total', host=host, code=status_code)
+
+    def response_bytes(self, host, count):
+        self.inc('netimpact_http_response_bytes_total', count, host=host)
+
+    def rows(self, network, account, direction, count, **labels):
+        """Record rows in from the network or out to the batch files of an account"""
+        self.inc('netimpact_rows_total', count, network=network, account=account, direction=direction, **labels)
+
+    def finish(self, success):
+        """Record the run wide metrics once the run is over"""
+        now = time.time()
+        self.set('netimpact_run_duration_seconds', now - self.started)
+        self.set('netimpact_run_success', int(success))
+        self.set('netimpact_run_timestamp_seconds', now)
+
+    def prometheus(self):
+        """Metrics in the Prometheus text exposition format"""
+        with self.lock:
+            values = sorted(self.values.items())
+        lines = []
+        for name, (kind, help_text) in METRICS.items():
+            samples = [(labels, value) for (n, labels), value in values if n == name]
+            if not samples:
+                continue
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                label_text = ','.join(f'{k}="{escape_label(v)}"' for k, v in labels)
+                lines.append(f'{name}{{{label_text}}} {value:g}' if label_text else f'{name} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """JSON run report: run timing, stages in the order they finished, and every metric with its labels"""
+        with self.lock:
+            values = sorted(self.values.items())
+            stages = list(self.stages)
+        return {
+            'started': datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+            'stages': stages,
+            'metrics': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in values],
+        }
+
+    def write(self, directory, name='netimpact'):
+        """Write {name}.prom for the node exporter textfile collector and a {name}-run-<start time>.json report to the directory.
+        The .prom file is written to a temporary file and renamed, so the collector never reads a partial file.
+
+        Arguments:
+            directory {string} -- Output directory, usually the textfile collector directory
+
+        Keyword Arguments:
+            name {string} -- File name prefix (default: {'netimpact'})
+
+        Returns:
+            tuple -- (Prometheus file path, JSON report path)
+        """
+        os.makedirs(directory, exist_ok=True)
+        prom_path = os.path.join(directory, f'{name}.prom')
+        with open(prom_path + '.tmp', 'w') as f:
+            f.write(self.prometheus())
+        os.replace(prom_path + '.tmp', prom_path)
+        report_path = os.path.join(directory, f'{name}-run-{datetime.fromtimestamp(self.started, timezone.utc):%Y%m%dT%H%M%SZ}.json')
+        with open(report_path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+        return prom_path, report_path
+
+
+def metric_key(name, labels):
+    """(metric name, sorted label tuple) key of a sample"""
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
@@ -1,18 +1,17 @@
 #!/usr/bin/env python3
 
+# Network modules, the Impact client and the upload stages are imported inside cli once they are known to be needed,
+# so --help, --version and short runs do not pay for requests, boto3 or pandas
+import netimpact
 import netimpact.processor as P
-from netimpact.awin import AWin
-from netimpact.admitad import Admitad
-from netimpact.linkshare import Linkshare
-from netimpact.impact import Impact #, Clicker
+import netimpact.networks
 import click
 import toml
-import boto3
-from s3fs import S3FileSystem
-import pandas as pd
 
-import logging,os,time
-from datetime import datetime, timedelta, date
+import logging,os,shutil,tempfile,threading
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, date, timezone
 logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
 
 @click.argument('networks')
@@ -24,15 +23,70 @@ logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
 @click.option('--s3_upload', '-s', default=False, help='Name of the S3 bucket to upload data to. References ~/.aws/credentials')
 @click.option('--target_date', '-d', type=click.DateTime(formats=["%Y-%m-%d"]),
               default=str(date.today()-timedelta(1)), help='Transactions from what day? Format: %Y-%m-%d')
+@click.option('--cache_dir', default='.netimpact', help='Directory for the on-disk partner and group caches and the run state. Defaults to .netimpact in the current directory.')
+@click.option('--refresh_partners', is_flag=True, default=False, help='Rebuild the partner cache from the full Impact partner list.')
+@click.option('--page_workers', default=1, help='Number of parallel requests used to fetch the remaining pages of paginated Impact endpoints.')
+@click.option('--partner_workers', default=1, help='Number of new partners created in Impact at the same time.')
+@click.option('--workers', default=1, help='Number of network accounts to run concurrently. Each network is also capped by max_workers in its config section.')
+@click.option('--engine', type=click.Choice(P.ENGINES), default='python', help='Transaction transform engine. pandas runs the transform as batched column operations.')
+@click.option('--start_date', '--start-date', type=click.DateTime(formats=["%Y-%m-%d"]), default=None, help='Backfill transactions day by day from this day up to --end_date. Completed days are checkpointed and skipped on restart. Format: %Y-%m-%d')
+@click.option('--end_date', '--end-date', type=click.DateTime(formats=["%Y-%m-%d"]), default=None, help='Last day of the backfill. Defaults to --target_date. Format: %Y-%m-%d')
+@click.option('--transform_workers', default=1, help='Number of processes transforming the transactions of a backfill (--start_date). Use up to the number of cores.')
+@click.option('--incremental', is_flag=True, default=False, help='Only import transactions since the last successful sync of each account, up to now. The first run starts from --target_date.')
+@click.option('--overlap', default=60, help='Minutes before the last successful sync that an --incremental run starts from again, to pick up late transactions.')
+@click.option('--resubmit', is_flag=True, default=False, help='Upload every transaction again, including the ones already submitted to Impact by an earlier run.')
+@click.option('--reconcile', is_flag=True, default=False, help='Compare the transactions against the actions already in Impact and only upload new conversions and real status or amount changes.')
+@click.option('--record', 'record_dir', default=None, help='Record every Impact and network API request and response of the run to this directory, for --replay.')
+@click.option('--replay', 'replay_dir', default=None, help='Answer every Impact and network API request from a directory recorded with --record, without network access or rate limiting. Implies --no_upload and no S3 upload, and runs on a throwaway copy of the caches and run state.')
+@click.option('--metrics_dir', default=None, help='Directory to write run metrics to: netimpact.prom for the Prometheus node exporter textfile collector and a JSON run report.')
+@click.version_option(version=netimpact.__version__, prog_name='netimpact')
 @click.command()
-def cli(networks,config,partners,transactions,groups,no_upload,s3_upload,target_date):
+def cli(networks,config,partners,transactions,groups,no_upload,s3_upload,target_date,cache_dir,refresh_partners,page_workers,partner_workers,workers,engine,start_date,end_date,transform_workers,incremental,overlap,resubmit,reconcile,metrics_dir,record_dir,replay_dir):
     """Default CLI method to get new partners and transactions from the
     provided NETWORKS and create them in the Impact program.
 
-    NETWORKS is the comma separated list of networks to operate on (currently accepts awin,linkshare,admitad)
+    NETWORKS is the comma separated list of networks to operate on (currently accepts awin,linkshare (or ls, rakuten),admitad)
     """
+    try:
+        network_names = netimpact.networks.parse(networks)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='NETWORKS')
+    if record_dir and replay_dir:
+        raise click.BadParameter('use either --record or --replay', param_hint='--record/--replay')
+    if transform_workers > 1 and not start_date:
+        raise click.BadParameter('only applies to backfills, use it with --start_date', param_hint='--transform_workers')
+    from netimpact import transport
+    from netimpact.impact import Impact
+    from netimpact.cache import PartnerCache, GroupMembershipCache, MetadataCache
+    from netimpact.ftpupload import FTPUploader
+    from netimpact.state import Checkpoints, Watermarks, SubmittedIndex
+    from netimpact.metrics import RunMetrics
+    from netimpact.cassette import Cassette
+
     c = toml.load(config)
     logging.info(f'Starting import process for {networks}')
+    metrics = RunMetrics()
+    cassette = None
+    if record_dir:
+        cassette = Cassette(record_dir, 'record')
+    elif replay_dir:
+        cassette = Cassette(replay_dir, 'replay')
+        # Uploads are not HTTP API calls and cannot be replayed
+        no_upload, s3_upload = True, False
+        # A replay runs on a throwaway copy of the caches and an empty run state. It never changes what real runs import,
+        # and the partner pages and tokens it reads from the recording (redacted ones included) never reach the real caches
+        replay_cache = tempfile.TemporaryDirectory(prefix='netimpact-replay-')
+        for name in os.listdir(cache_dir) if os.path.isdir(cache_dir) else []:
+            if name.endswith('.db') and name != 'state.db':
+                shutil.copy2(os.path.join(cache_dir, name), replay_cache.name)
+        cache_dir = replay_cache.name
+    transport.configure(rate_limits=c.get('RateLimits'), metrics=metrics, cassette=cassette, **c.get('HTTP', {}))
+    # One partner map per Impact account and program, so configs sharing a cache_dir never read each other's partner IDs
+    partner_cache = PartnerCache(
+        os.path.join(cache_dir, f'partners-{c["Impact"]["impact_sid"]}-{c["Impact"]["program_id"]}.db'),
+        max_age=timedelta(hours=c['Impact'].get('partner_cache_max_age', 24))
+        )
+    metadata_cache = MetadataCache(os.path.join(cache_dir, 'metadata.db'))
     i = Impact(
         c['Impact']['impact_sid'],
         c['Impact']['impact_token'],
@@ -41,47 +95,213 @@ def cli(networks,config,partners,transactions,groups,no_upload,s3_upload,target_
         c['Impact']['program_id'],
         c['Impact']['desktop_action_tracker_id'],
         c['Impact']['mobile_action_tracker_id'],
-        reload_groups=groups
+        reload_groups=groups,
+        partner_cache=partner_cache,
+        refresh_partners=refresh_partners,
+        page_workers=page_workers,
+        partner_workers=partner_workers,
+        group_cache=GroupMembershipCache(
+            os.path.join(cache_dir, 'groups.db'),
+            max_age=timedelta(hours=c['Impact'].get('group_cache_max_age', 24))
+            ),
+        metadata_cache=metadata_cache,
+        metadata_ttl=timedelta(hours=c['Impact'].get('metadata_cache_max_age', 24)),
+        ftp_uploader=FTPUploader(
+            c['Impact']['ftp_un'],
+            c['Impact']['ftp_p'],
+            host=c['Impact'].get('ftp_host', 'batch.impactradius.com'),
+            port=c['Impact'].get('ftp_port', 21),
+            sessions=c['Impact'].get('ftp_sessions', 2)
+            )
         )
 
+    # Only load the Impact metadata the selected modes use
+    with metrics.stage('impact_metadata'):
+        i.prefetch(contract=partners, partners=partners or transactions, groups=partners or groups)
+
     network_list = []
-    network_names = []
-    if 'awin' in networks.lower():
-        network_list.append(AWin(c['Awin']['oauth']))
-        network_names.append('awin')
-
-    if 'admitad' in networks.lower():
-        network_list.append(Admitad(c['Admitad']['client_id'], c['Admitad']['client_secret']))
-        network_names.append('admitad')
-    
-    if 'ls' in networks.lower() or 'linkshare' in networks.lower() or 'rakuten' in networks.lower():
-        network_list.append(Linkshare(c['Linkshare']['report_names']['Transactions'], c['Linkshare']['report_names']['Publishers']))
-        network_names.append('linkshare')
-
-    for n in network_list:
-        logging.info(f'Running data import for {n.network_name} into Impact program {i.program_id}')
-        for account_name,account_id in c[n.network_name]['account_ids'].items():
-            if account_name not in i.groups_dict.keys():
-                i.groups_dict[account_name] = i.create_group(account_name)
-            if partners:
-                i.new_publisher_validation(account_id, account_name, n)
-            if transactions:
-                file_path_m, file_path_p = P.transactions_process(i, account_id, account_name, n, target_date)
-                if no_upload:
-                    pass
-                else:
-                    i.batch_to_impact(file_path_m, file_path_p)
-                if s3_upload:
-                    session = boto3.Session(
-                        aws_access_key_id=c['S3']['access_key'],
-                        aws_secret_access_key=c['S3']['secret_access_key'],
-                    )
-                    s3 = session.resource('s3')
-                    df = pd.read_csv(file_path_p)
-                    pq_file = f'{str(file_path_p).rstrip(".csv")}.parquet'
-                    df.to_parquet(pq_file)
-                    s3.Object(c['S3']['bucket'], pq_file).put(Body=open(pq_file, 'rb'))
-                    s3.Object(c['S3']['bucket'], str(file_path_m)).put(Body=open(str(file_path_m), 'rb'))
-                    
-                    s3.Object(c['S3']['bucket'], str(file_path_m)).put(Body=open(str(file_path_m), 'rb'))
-                    logging.info("Files uploaded to {(c['S3']['bucket']}")
\ No newline at end of file
+    for name in network_names:
+        network_class = netimpact.networks.load(name)
+        network_list.append(network_class.from_config(c[network_class.network_name], metadata_cache=metadata_cache))
+
+    accounts = [(n, account_name, account_id) for n in network_list for account_name, account_id in c[n.network_name]['account_ids'].items()]
+    s3_uploader = None
+    if s3_upload:
+        from netimpact.s3upload import S3Uploader
+        s3_uploader = S3Uploader(
+            c['S3']['bucket'],
+            access_key=c['S3'].get('access_key'),
+            secret_access_key=c['S3'].get('secret_access_key'),
+            endpoint_url=c['S3'].get('endpoint_url'),
+            region_name=c['S3'].get('region'),
+            max_workers=c['S3'].get('max_workers', 4),
+            )
+    options = dict(no_upload=no_upload, s3_uploader=s3_uploader, engine=engine, metrics=metrics)
+    if not resubmit:
+        options['index'] = SubmittedIndex(os.path.join(cache_dir, 'state.db'))
+    if reconcile:
+        from netimpact.reconcile import Reconciler
+        options['reconciler'] = Reconciler(i, lookback=timedelta(days=c['Impact'].get('reconcile_lookback_days', 30)))
+    success = False
+    try:
+        if start_date:
+            backfill(c, i, accounts, workers, start_date, end_date or target_date, partners, transactions,
+                     Checkpoints(os.path.join(cache_dir, 'state.db')), transform_workers=transform_workers, **options)
+        else:
+            if incremental:
+                options.update(watermarks=Watermarks(os.path.join(cache_dir, 'state.db')), overlap=timedelta(minutes=overlap))
+            jobs = [(n, account_name, account_id, target_date) for n, account_name, account_id in accounts]
+            run_accounts(c, i, jobs, workers, partners=partners, transactions=transactions, **options)
+        success = True
+    finally:
+        i.ftp_uploader.close()
+        if cassette is not None:
+            cassette.close()
+        if replay_dir:
+            replay_cache.cleanup()
+        metrics.finish(success)
+        if metrics_dir:
+            prom_path, report_path = metrics.write(metrics_dir)
+            logging.info(f'Run metrics written to {prom_path} and {report_path}')
+
+
+def backfill(c, i, accounts, workers, start_date, end_date, partners, transactions, checkpoints, transform_workers=1, **options):
+    """Import every day from start_date to end_date with one shared Impact object. Partners are validated once per account,
+    then the (account, day) transaction imports run in parallel within each network's max_workers cap. Days already
+    recorded in the checkpoints are skipped, so an interrupted backfill restarts where it stopped.
+
+    Arguments:
+        c {dict} -- Loaded TOML config
+        i {Impact} -- Impact object shared by every account in the run
+        accounts {list} -- (network object, account name, account ID) tuples
+        workers {int} -- Number of imports run at the same time
+        start_date {datetime} -- First day of the backfill
+        end_date {datetime} -- Last day of the backfill
+        checkpoints {Checkpoints} -- Store of completed (network, account, day) imports
+
+    Keyword Arguments:
+        transform_workers {int} -- Number of processes the transaction batches are transformed in, taken once the partners are validated (default: {1})
+    """
+    days = [start_date + timedelta(d) for d in range((end_date - start_date).days + 1)]
+    logging.info(f'Backfilling {len(days)} days from {start_date:%Y-%m-%d} to {end_date:%Y-%m-%d}')
+    if partners:
+        jobs = [(n, account_name, account_id, None) for n, account_name, account_id in accounts]
+        run_accounts(c, i, jobs, workers, partners=True, transactions=False, **options)
+    if transactions:
+        if options.get('reconciler') is not None:
+            # One Impact action index for the whole backfill instead of one per day
+            options['reconciler'].load(start_date, end_date)
+        jobs = [(n, account_name, account_id, day) for n, account_name, account_id in accounts for day in days
+                if not checkpoints.is_done(n.network_name, account_name, day)]
+        logging.info(f'{len(jobs)} of {len(accounts) * len(days)} account days left to import')
+        transform_pool = P.TransformPool(i, transform_workers) if transform_workers > 1 and jobs else None
+        try:
+            run_accounts(c, i, jobs, workers, partners=False, transactions=True, checkpoints=checkpoints, transform_pool=transform_pool, **options)
+        finally:
+            if transform_pool is not None:
+                transform_pool.close()
+
+
+def run_accounts(c, i, jobs, workers, **options):
+    """Run process_account for every job, concurrently when workers > 1
+
+    Arguments:
+        c {dict} -- Loaded TOML config
+        i {Impact} -- Impact object shared by every account in the run
+        jobs {list} -- (network object, account name, account ID, target date) tuples
+        workers {int} -- Number of jobs run at the same time
+    """
+    if workers <= 1:
+        for n, account_name, account_id, target_date in jobs:
+            process_account(c, i, n, account_name, account_id, target_date, **options)
+        return
+
+    # Each network gets its own pool capped at its max_workers setting, all drawing from the global worker budget
+    budget = threading.Semaphore(workers)
+    def run(n, account_name, account_id, target_date):
+        with budget:
+            process_account(c, i, n, account_name, account_id, target_date, **options)
+
+    pools = {n.network_name: ThreadPoolExecutor(min(workers, c[n.network_name].get('max_workers', workers)), thread_name_prefix=n.network_name) for n, _, _, _ in jobs}
+    futures = {}
+    for n, account_name, account_id, target_date in jobs:
+        label = account_name if target_date is None else f'{account_name} {target_date:%Y-%m-%d}'
+        futures[pools[n.network_name].submit(run, n, account_name, account_id, target_date)] = label
+    failed = []
+    for future in as_completed(futures):
+        try:
+            future.result()
+        except Exception:
+            logging.exception(f'Import failed for {futures[future]}')
+            failed.append(futures[future])
+    for pool in pools.values():
+        pool.shutdown()
+    if failed:
+        raise click.ClickException(f'Import failed for {", ".join(failed)}')
+
+
+def process_account(c, i, n, account_name, account_id, target_date, partners, transactions, no_upload, s3_uploader, engine='python', checkpoints=None,
+                    watermarks=None, overlap=timedelta(0), index=None, metrics=None, reconciler=None, transform_pool=None):
+    """Run the partner validation, transaction import and uploads for a single network account and day
+
+    Arguments:
+        c {dict} -- Loaded TOML config
+        i {Impact} -- Impact object shared by every account in the run
+        n {object} -- Network object (currently one of AWin, Admitad, Linkshare)
+        account_name {string} -- Network program/account name
+        account_id {string} -- Network account ID
+        target_date {datetime} -- Day to import transactions for
+        s3_uploader {S3Uploader} -- Shared S3 upload stage, None to skip the S3 upload
+
+    Keyword Arguments:
+        engine {string} -- Transform engine, one of processor.ENGINES (default: {'python'})
+        checkpoints {Checkpoints} -- Records the day as done once it is imported (default: {None})
+        watermarks {Watermarks} -- Import only the window since the last successful sync, starting from target_date on the first run (default: {None})
+        overlap {timedelta} -- How far before the last successful sync the window starts again (default: {timedelta(0)})
+        index {SubmittedIndex} -- Leaves out transactions already submitted to Impact and records the uploaded ones (default: {None})
+        metrics {RunMetrics} -- Records the stage timings, partners and rows of the account (default: {None})
+        reconciler {Reconciler} -- Leaves out transactions whose current state Impact already has (default: {None})
+        transform_pool {TransformPool} -- Worker processes the transaction batches are transformed in (default: {None})
+    """
+    logging.info(f'Running data import for {n.network_name} account {account_name} into Impact program {i.program_id}')
+    labels = dict(network=n.network_name, account=account_name)
+
+    def stage(name):
+        return metrics.stage(name, **labels) if metrics is not None else nullcontext()
+
+    if partners:
+        with stage('partners'):
+            i.ensure_group(n.network_name)
+            i.ensure_group(account_name)
+            created, total = i.new_publisher_validation(account_id, account_name, n)
+        if metrics is not None:
+            metrics.inc('netimpact_partners_total', total, kind='processed', **labels)
+            metrics.inc('netimpact_partners_total', created, kind='created', **labels)
+    if transactions:
+        windows = None
+        if watermarks is not None:
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+            windows = watermarks.windows(n, account_name, now, overlap=overlap, default_start=target_date)
+            target_date = now
+        with stage('transactions'):
+            file_path_m, file_path_p = P.transactions_process(i, account_id, account_name, n, target_date, engine=engine,
+                                                              parquet=s3_uploader is not None, windows=windows, index=index, metrics=metrics,
+                                                              reconciler=reconciler, transform_pool=transform_pool)
+        if s3_uploader is not None:
+            # Before the Impact upload, which removes the local files once they are sent
+            with stage('s3_upload'):
+                s3_uploader.upload_all([P.parquet_path(file_path_p), file_path_m])
+        failed = []
+        if no_upload:
+            pass
+        else:
+            with stage('impact_upload'):
+                failed = i.batch_to_impact(file_path_m, file_path_p)
+            if index is not None:
+                index.commit([p for p in (file_path_m, file_path_p) if p not in failed])
+        # Only a day whose batch files reached Impact is done, --no_upload and --replay runs leave it to be imported again
+        uploaded = not no_upload and not failed
+        if checkpoints is not None and uploaded:
+            checkpoints.mark_done(n.network_name, account_name, target_date)
+        if watermarks is not None and uploaded:
+            watermarks.advance(n.network_name, account_name, windows)
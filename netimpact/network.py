@@ -1,11 +1,21 @@
 class Network:
     network_name = 'NETWORK'
+    date_format = '%Y-%m-%d'
+    statuses = ('approved', 'declined', 'pending') # Statuses requested separately, ('all',) if one request returns every status
     def __init__(self):
         '''
         Pass network API credentials/secrets/tokens to the object. Use them in the two required functions below to get publishers and transactions
         '''
         pass
 
+    @classmethod
+    def from_config(cls, config, metadata_cache=None):
+        '''
+        Create the network object from its config section, the TOML table named after network_name. Register the class
+        in networks.NETWORKS, or from another package under the netimpact.networks entry point group, to make it selectable on the CLI
+        '''
+        return cls()
+
     def get_pubs(self, acct):
         publishers = [{'name':'example','id':'example_id','site_url':'example_url'}] # Replace this with whatever network call needs to happen to get a pub list
         pub_list = []
@@ -18,10 +28,13 @@ class Network:
             pub_list.append(pub)
         return pub_list
 
-    def get_all_transactions(self, acct, start, end, status):
-        transactions = [{'name':'example','id':'example_id','site_url':'example_url'}] # Replace this with whatever network call needs to happen to get a pub list
+    def iter_transactions(self, acct, start, end, status):
+        '''
+        Yield (status, transaction) pairs as the network API pages come in, so no more than a page is held in memory.
+        With statuses = ('all',) the status of each transaction is one of approved, pending, declined
+        '''
+        transactions = [{'name':'example','id':'example_id','site_url':'example_url'}] # Replace this with whatever paginated network call needs to happen to get transactions
 
-        transaction_list = []
         for t in transactions:
             transaction = {
                     'transactionDate': t['action_time'],
@@ -34,6 +47,21 @@ class Network:
                     'customerCountry': t['action_country'],
                     'advertiserCountry': t['action_country']
                 }
-            transaction_list.append(transaction)
-        return transaction_list
+            yield status, transaction
 
+    def get_all_transactions(self, acct, start, end, status):
+        return [t for _, t in self.iter_transactions(acct, start, end, status)]
+
+    def date_formatter(self, target_date, target_start_date=False):
+        '''
+        Format the start and end of the period from target_start_date (or target_date) to target_date the way the network API expects them
+        '''
+        start = (target_start_date or target_date).strftime(self.date_format)
+        end = target_date.strftime(self.date_format)
+        return start, end
+
+    def window_formatter(self, start, end):
+        '''
+        Format an arbitrary start and end datetime for incremental syncs, widened to whatever granularity the network API supports
+        '''
+        return start.strftime(self.date_format), end.strftime(self.date_format)
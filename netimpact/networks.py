@@ -0,0 +1,84 @@
+import importlib
+
+# Built in networks: name -> (module, class). A network module is only imported once the network is selected.
+NETWORKS = {
+    'awin': ('netimpact.awin', 'AWin'),
+    'admitad': ('netimpact.admitad', 'Admitad'),
+    'linkshare': ('netimpact.linkshare', 'Linkshare'),
+}
+ALIASES = {
+    'ls': 'linkshare',
+    'rakuten': 'linkshare',
+}
+# Other packages can add networks under this entry point group, e.g. 'cj = mypackage.cj:CJ'
+ENTRY_POINT_GROUP = 'netimpact.networks'
+
+
+def plugins():
+    """Networks registered by installed packages under ENTRY_POINT_GROUP
+
+    Returns:
+        dict -- {network name : entry point}
+    """
+    from importlib.metadata import entry_points
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        eps = eps.select(group=ENTRY_POINT_GROUP)
+    else:
+        eps = eps.get(ENTRY_POINT_GROUP, [])
+    return {ep.name.lower(): ep for ep in eps}
+
+
+def resolve(name):
+    """Registered network name for a CLI network name or alias
+
+    Arguments:
+        name {string} -- Network name as given on the command line
+
+    Returns:
+        string -- Registered network name, None if no network of that name is registered
+    """
+    name = ALIASES.get(name.strip().lower(), name.strip().lower())
+    if name in NETWORKS or name in plugins():
+        return name
+    return None
+
+
+def parse(networks):
+    """Registered network names for a comma separated NETWORKS argument, matched exactly (no substrings)
+
+    Arguments:
+        networks {string} -- Comma separated network names or aliases
+
+    Returns:
+        list -- Registered network names in the given order, without duplicates
+
+    Raises:
+        ValueError -- A name is not a registered network or alias
+    """
+    names = []
+    for name in networks.split(','):
+        if not name.strip():
+            continue
+        resolved = resolve(name)
+        if resolved is None:
+            known = sorted(set(NETWORKS) | set(ALIASES) | set(plugins()))
+            raise ValueError(f'Unknown network {name.strip()!r}, expected one of {", ".join(known)}')
+        if resolved not in names:
+            names.append(resolved)
+    return names
+
+
+def load(name):
+    """Import and return the network class registered under name
+
+    Arguments:
+        name {string} -- Registered network name (see resolve)
+
+    Returns:
+        class -- Network class
+    """
+    if name in NETWORKS:
+        module, attr = NETWORKS[name]
+        return getattr(importlib.import_module(module), attr)
+    return plugins()[name].load()
@@ -0,0 +1,49 @@
+import queue
+import threading
+
+
+def prefetch(pages, depth=1):
+    """Iterate pages from a background thread, so the next pages download while the current one is processed
+
+    Arguments:
+        pages {iterable} -- Page iterable, typically a generator issuing one request per page
+
+    Keyword Arguments:
+        depth {int} -- Number of pages fetched ahead of the consumer (default: {1})
+
+    Yields:
+        object -- Pages in the order of the iterable. An exception raised by the iterable is raised here.
+    """
+    buffer = queue.Queue(depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for page in pages:
+                if not put((page, None)):
+                    return
+            put((done, None))
+        except BaseException as e:
+            put((done, e))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            page, error = buffer.get()
+            if error is not None:
+                raise error
+            if page is done:
+                return
+            yield page
+    finally:
+        stop.set()
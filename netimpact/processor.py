@@ -1,75 +1,113 @@
 import logging
+import multiprocessing
 import os
 import csv
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from datetime import datetime, timedelta
 from pathlib import Path
 
-def new_transaction_lists(impact, t_lists, account_name, network_name):
-    """Transforms new transaction records by adding the Impact tracker ID for the environment (desktop/mobile),
+NEW_TRANSACTION_HEADERS = ["CampaignId","ActionTrackerId","EventDate","OrderId","MediaPartnerId",'CustomerStatus',"CurrencyCode","Amount","Category","Sku","Quantity",'Text1','PromoCode','Country','OrderLocation','Text2','Date1','Note','Numeric1','OrderStatus','VoucherCode','Modified']
+MODIFIED_TRANSACTION_HEADERS = ['ActionTrackerID','Oid','Amount','Reason']
+ENGINES = ('python', 'pandas')
+# (OID, status, amount) columns identifying a row already submitted to Impact, see state.SubmittedIndex
+NEW_TRANSACTION_KEY = tuple(NEW_TRANSACTION_HEADERS.index(h) for h in ('OrderId', 'CustomerStatus', 'Amount'))
+MODIFIED_TRANSACTION_KEY = tuple(MODIFIED_TRANSACTION_HEADERS.index(h) for h in ('Oid', 'Reason', 'Amount'))
+# Parquet column types for the conversions file, columns not listed are strings
+NEW_TRANSACTION_TYPES = {'Amount': 'float64', 'Quantity': 'int64', 'Numeric1': 'int64', 'Modified': 'timestamp'}
+
+def action_tracker_id(impact, device):
+    if device == 'Desktop':
+        return impact.desktop_action_tracker_id
+    elif device == 'Mobile':
+        return impact.mobile_action_tracker_id
+
+def new_transaction_row(impact, t, account_name, network_name, modified):
+    """Transforms a single new transaction record by adding the Impact tracker ID for the environment (desktop/mobile),
         finding the correct Impact partner  ID from the network publisher ID, and determining the commission rate.
         See README for contract payout groups requirements for correct payments.
 
     Arguments:
-        new_transactions {list} -- list of transaction dicts. See below for required key value pairs in the dictionary
+        t {dict} -- transaction dict, see the Network template for the required key value pairs
+        account_name {string} -- Network program/account name
+        network_name {string} -- Network name
+        modified {string} -- Modified timestamp of the batch
+
+    Returns:
+        list -- Impact conversions row, None if no Impact partner is known for the publisher
+    """
+    try:
+        mpid = impact.existing_partner_dict[t['publisherId']]
+    except KeyError as e:
+        try:
+            mpid = impact.existing_partner_dict[str(t['publisherId'])]
+        except KeyError as e:
+            logging.warning(f'No valid partner {t["publisherId"]} found for {network_name} transaction {t["id"]}')
+            # mpid = 'NOMPID'
+            return None
+    try:
+        commission_rate = int(round(float(t['commissionAmount']['amount']) / float(t['saleAmount']['amount']), 2) * 100)
+    except ZeroDivisionError as e:
+        commission_rate = 0
+
+    return [
+        impact.program_id,
+        action_tracker_id(impact, t['device']),
+        t['transactionDate'],
+        t['id'],
+        mpid,
+        t['status'],
+        t['saleAmount']['currency'],
+        t['saleAmount']['amount'],
+        'cat',
+        'sku',
+        1,
+        account_name,
+        account_name,
+        # t['voucherCode'],
+        t['customerCountry'],
+        t['customerCountry'],
+        t['advertiserCountry'],
+        t['transactionDate'],
+        account_name,
+        commission_rate,
+        'pending',
+        t['voucherCode'],
+        modified
+        ]
+
+def new_transaction_lists(impact, t_lists, account_name, network_name):
+    """Transforms new transaction records with new_transaction_row, leaving out the ones without a known partner
+
+    Arguments:
+        t_lists {list} -- lists of transaction dicts
         account_name {string} -- Network program/account name
         network_name {string} -- Network name
 
     Returns:
-        tuple -- (list of Impact conversions upload headers, list of amended transaction dicts)
+        tuple -- (list of Impact conversions upload headers, list of conversion rows)
+    """
+    modified = f'{datetime.now():%Y-%m-%dT%H:%M:%S}'
+    rows = (new_transaction_row(impact, t, account_name, network_name, modified) for l in t_lists for t in l)
+    return NEW_TRANSACTION_HEADERS, [row for row in rows if row is not None]
+
+def modified_transaction_row(impact, t, reason):
+    """Transforms a single modified transaction record by adding the Impact tracker ID for the environment (desktop/mobile) and the Reason Code for the modification.
+    Keeps the amount in the case of an approval (VALIDATED_ORDER) and zeroes the amount in the case of a reversal (RETURNED).
+
+    Arguments:
+        t {dict} -- transaction dict
+        reason {string} -- VALIDATED_ORDER or RETURNED
+
+    Returns:
+        list -- Impact modifications row
     """
-    headrow = ["CampaignId","ActionTrackerId","EventDate","OrderId","MediaPartnerId",'CustomerStatus',"CurrencyCode","Amount","Category","Sku","Quantity",'Text1','PromoCode','Country','OrderLocation','Text2','Date1','Note','Numeric1','OrderStatus','VoucherCode','Modified']
-    t_list = []
-    for l in t_lists:
-        for t in l:
-            try:
-                mpid = impact.existing_partner_dict[t['publisherId']]
-            except KeyError as e:
-                try:
-                    mpid = impact.existing_partner_dict[str(t['publisherId'])]
-                except KeyError as e:
-                    logging.warning(f'No valid partner {t["publisherId"]} found for {network_name} transaction {t["id"]}')
-                    # mpid = 'NOMPID'
-                    continue
-            try:
-                commission_rate = int(round(float(t['commissionAmount']['amount']) / float(t['saleAmount']['amount']), 2) * 100)
-            except ZeroDivisionError as e:
-                commission_rate = 0
-            if t['device'] == 'Desktop':
-                at_id = impact.desktop_action_tracker_id
-            elif t['device'] == 'Mobile':
-                at_id = impact.mobile_action_tracker_id
-
-            transaction = [
-                impact.program_id,
-                at_id,
-                t['transactionDate'],
-                t['id'],
-                mpid,
-                t['status'],
-                t['saleAmount']['currency'],
-                t['saleAmount']['amount'],
-                'cat',
-                'sku',
-                1,
-                account_name,
-                account_name,
-                # t['voucherCode'],
-                t['customerCountry'],
-                t['customerCountry'],
-                t['advertiserCountry'],
-                t['transactionDate'],
-                account_name,
-                commission_rate,
-                'pending',
-                t['voucherCode'],
-                f'{datetime.now():%Y-%m-%dT%H:%M:%S}'
-                ]
-            t_list.append(transaction)  
-    return headrow, t_list
+    amount = t['saleAmount']['amount'] if reason == 'VALIDATED_ORDER' else 0
+    return [action_tracker_id(impact, t['device']), t['id'], amount, reason]
 
 def modified_transaction_lists(impact, approved, declined):
-    """Transforms modified transaction records by adding the Impact tracker ID for the environment (desktop/mobile) and the Reason Code for the modification.
-    Updates the amount in the case of an approval and zeroes the amount in the case of a reversal.
+    """Transforms modified transaction records with modified_transaction_row
 
     Arguments:
         approved {list} -- List of approved transactions (dictionaries)
@@ -78,68 +116,204 @@ def modified_transaction_lists(impact, approved, declined):
     Returns:
         tuple -- Two items, the Impact modification file standard headers, and the amended list of transactions to be modifed
     """        
-    headrow = ['ActionTrackerID','Oid','Amount','Reason']
-    t_list = []
-    for t in approved:
-        if t['device'] == 'Desktop':
-            at_id = impact.desktop_action_tracker_id
-        elif t['device'] == 'Mobile':
-            at_id = impact.mobile_action_tracker_id
-        transaction = [
-            at_id,
-            t['id'],
-            t['saleAmount']['amount'],
-            'VALIDATED_ORDER'
-            ]
-        t_list.append(transaction)
-    for t in declined:
-        if t['device'] == 'Desktop':
-            at_id = impact.desktop_action_tracker_id
-        elif t['device'] == 'Mobile':
-            at_id = impact.mobile_action_tracker_id
-        transaction = [
-            at_id,
-            t['id'],
-            0,
-            'RETURNED'
-            ]
-        t_list.append(transaction)
-
-    return headrow, t_list
-
-def prepare_transactions(impact, account_id, network, target_date):
-    """Extract transactions from the network object methods (date formats are specific to each network) and pass them to the transformation functions
-    TODO :: move the date formatting to the network objects
-    TODO :: historical data functions
+    t_list = [modified_transaction_row(impact, t, 'VALIDATED_ORDER') for t in approved]
+    t_list += [modified_transaction_row(impact, t, 'RETURNED') for t in declined]
+    return MODIFIED_TRANSACTION_HEADERS, t_list
+
+def iter_transactions(network, account_id, target_date, target_start_date=False, windows=None):
+    """Stream transactions from the network object as its pages come in (date formats are specific to each network)
 
     Arguments:
-        account_id {string} -- Network specific authentication token to get publisher list
+        account_id {string} -- Network account ID
         network {object} -- Network object (currently one of AWin, Admitad, Linkshare)
+        target_date {datetime} -- Last day of the period
     Keyword Arguments:
-        historical {bool} -- Not currently implemented (default: {False})
+        target_start_date {datetime} -- First day of a multi-day period, the period is the single target_date if not given (default: {False})
+        windows {dict} -- {status : (start datetime, end datetime)} sync windows per network status (see network.statuses), used instead of the day period (default: {None})
 
-    Returns:
-        tuple -- (list of approved transactions, list of declined, list of pending, end datetime object) (all amended to fit Impact formatting requirements)
+    Yields:
+        tuple -- (one of approved, declined, pending, transaction dict)
     """
-    approved = []
-    pending = []
-    declined = []
     logging.info(f'Getting {network.network_name} transactions and modifications for account {account_id}')
-    start,end = network.date_formatter(target_date)
+    def period(status):
+        if windows is not None:
+            return network.window_formatter(*windows[status])
+        return network.date_formatter(target_date, target_start_date)
+
+    for status in network.statuses:
+        for record_status, t in network.iter_transactions(account_id, *period(status), status):
+            # Linkshare declines are not sent to Impact
+            if network.network_name == 'Linkshare' and record_status == 'declined':
+                continue
+            yield record_status, t
+
+def batched(records, batch_size):
+    """Group an iterable into lists of at most batch_size items"""
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def transform_engine(engine):
+    """Look up the transform functions for an engine name
 
-    if network.network_name == 'Linkshare':
-        approved, pending, declined = network.get_all_transactions(account_id, start, end)
-        declined = []
+    Arguments:
+        engine {string} -- 'python' for the row by row transform, 'pandas' for the columnar transform in netimpact.columnar
 
-    else:            
-        approved = network.get_all_transactions(account_id, start, end, 'approved')
-        declined = network.get_all_transactions(account_id, start, end, 'declined')
-        pending = network.get_all_transactions(account_id, start, end, 'pending')
+    Returns:
+        tuple -- (new transactions transform function, modified transactions transform function)
+    """
+    if engine == 'pandas':
+        from netimpact import columnar
+        return columnar.new_transaction_lists, columnar.modified_transaction_lists
+    elif engine == 'python':
+        return new_transaction_lists, modified_transaction_lists
+    raise ValueError(f'Unknown transform engine {engine}, expected one of {ENGINES}')
 
-    return approved, declined, pending, target_date
+def transform_batch(impact, engine, batch, account_name, network_name):
+    """Transform one batch of (status, transaction) pairs into conversions and modifications rows
 
-def transactions_process(impact, account_id, account_name, network, target_date):
+    Arguments:
+        impact {Impact or TransformSnapshot} -- Source of the program ID, tracker IDs and partner map
+        engine {string} -- Transform engine, one of ENGINES
+        batch {list} -- (one of approved, declined, pending, transaction dict) tuples
+        account_name {string} -- Network program/account name
+        network_name {string} -- Network name
+
+    Returns:
+        tuple -- ({status : transactions in the batch}, conversions rows, modifications rows)
+    """
+    transform_new, transform_modified = transform_engine(engine)
+    by_status = {'approved': [], 'declined': [], 'pending': []}
+    for status, t in batch:
+        by_status[status].append(t)
+    headrow, new_rows = transform_new(impact, [[t for _, t in batch]], account_name, network_name)
+    headrow, modified_rows = transform_modified(impact, by_status['approved'], by_status['declined'])
+    return {status: len(ts) for status, ts in by_status.items()}, new_rows, modified_rows
+
+class TransformSnapshot:
+    """Read-only copy of the Impact attributes the transform uses, small and picklable enough to hand to worker processes
+
+    Arguments:
+        impact {Impact} -- Impact object to copy the program ID, tracker IDs and partner map from
+    """
+    def __init__(self, impact):
+        self.program_id = impact.program_id
+        self.desktop_action_tracker_id = impact.desktop_action_tracker_id
+        self.mobile_action_tracker_id = impact.mobile_action_tracker_id
+        with impact.lock:
+            self.existing_partner_dict = dict(impact.existing_partner_dict)
+
+_snapshot = None # TransformSnapshot of a TransformPool worker process
+
+def init_transform_worker(snapshot):
+    global _snapshot
+    _snapshot = snapshot
+
+def transform_shard(engine, batch, account_name, network_name):
+    """transform_batch against the snapshot of the worker process"""
+    return transform_batch(_snapshot, engine, batch, account_name, network_name)
+
+class TransformPool:
+    """Process pool running the CPU bound transform of transaction batches on every core. Each worker process gets a
+    TransformSnapshot of the Impact object once, when it starts, so take the pool after the partner map is final.
+    Batches can come from any number of account threads at once, each account's results come back in its batch order.
+    Workers are started from a fork server (spawned where there is none) rather than forked from this process, whose
+    account, prefetch and connection pool threads may hold logging, SQLite or Impact locks at the time.
+
+    Arguments:
+        impact {Impact} -- Impact object to snapshot
+        workers {int} -- Number of worker processes
+
+    Keyword Arguments:
+        depth {int} -- Batches per account in flight at a time, defaults to twice the number of workers (default: {None})
+    """
+    def __init__(self, impact, workers, depth=None):
+        self.workers = workers
+        self.depth = depth or 2 * workers
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self.pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context(method),
+                                        initializer=init_transform_worker, initargs=(TransformSnapshot(impact),))
+
+    def map(self, engine, batches, account_name, network_name):
+        """Yield transform_batch results for the batches in their order, with at most depth batches submitted ahead"""
+        pending = deque()
+        for batch in batches:
+            pending.append(self.pool.submit(transform_shard, engine, batch, account_name, network_name))
+            if len(pending) >= self.depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def close(self):
+        self.pool.shutdown()
+
+class ConversionsParquetWriter:
+    """Streams conversion rows into a Parquet file with an explicit schema, one record batch at a time
+
+    Arguments:
+        path {Path} -- Parquet file to write
+
+    Keyword Arguments:
+        batch_size {int} -- Number of rows buffered before a record batch is written (default: {50000})
+    """
+    def __init__(self, path, batch_size=50000):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        self.batch_size = batch_size
+        types = {'float64': pa.float64(), 'int64': pa.int64(), 'timestamp': pa.timestamp('s')}
+        self.schema = pa.schema([(h, types.get(NEW_TRANSACTION_TYPES.get(h), pa.string())) for h in NEW_TRANSACTION_HEADERS])
+        converters = {'float64': float, 'int64': int, 'timestamp': lambda v: datetime.strptime(v, '%Y-%m-%dT%H:%M:%S')}
+        self.converters = [converters.get(NEW_TRANSACTION_TYPES.get(h), str) for h in NEW_TRANSACTION_HEADERS]
+        self.writer = pq.ParquetWriter(str(path), self.schema)
+        self.buffer = []
+
+    def write_row(self, row):
+        self.buffer.append(row)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        arrays = []
+        for column, convert, field in zip(zip(*self.buffer), self.converters, self.schema):
+            if convert is str:
+                values = [None if v is None else str(v) for v in column]
+            else:
+                values = [None if v is None or v == '' else convert(v) for v in column]
+            arrays.append(self.pa.array(values, type=field.type))
+        self.writer.write_batch(self.pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def parquet_path(file_path_p):
+    """Path of the Parquet copy written next to the conversions CSV"""
+    return Path(file_path_p).with_suffix('.parquet')
+
+def transactions_process(impact, account_id, account_name, network, target_date, engine='python', parquet=False, windows=None, index=None, batch_size=5000,
+                         metrics=None, reconciler=None, transform_pool=None):
     """Main function running the extract and transform process for the network transaction data. Writes the results to CSV ready for upload.
+    Transactions are streamed from the network in batches and each batch goes through the transform and out to the conversions
+    and modifications files (and the Parquet copy) in a single pass, so no more than a batch is held in memory.
 
     Arguments:
         account_id {string} -- Network account ID
@@ -147,14 +321,23 @@ def transactions_process(impact, account_id, account_name, network, target_date)
         network {object} -- Network object (currently one of AWin, Admitad, Linkshare)
 
     Keyword Arguments:
-        historical {bool} -- Not implemented (default: {False})
+        engine {string} -- Transform engine, one of ENGINES. Both produce identical files (default: {'python'})
+        parquet {bool} -- Also write the conversions to a Parquet file next to the CSV (see parquet_path) in the same pass (default: {False})
+        windows {dict} -- {status : (start datetime, end datetime)} incremental sync windows. Files are then named after target_date to the second (default: {None})
+        index {SubmittedIndex} -- Leave out rows already submitted to Impact and stage the rest for index.commit once uploaded (default: {None})
+        batch_size {int} -- Number of transactions transformed and written at a time (default: {5000})
+        metrics {RunMetrics} -- Records the transactions read per status and the rows written per file (default: {None})
+        reconciler {Reconciler} -- Leave out conversions Impact already has and modifications that change nothing in Impact (default: {None})
+        transform_pool {TransformPool} -- Transform the batches in worker processes instead of this thread. The files are written in the same order (default: {None})
 
     Returns:
         file_path_m {string} -- path to the modifications file 
         file_path_p {string} -- path to the pending transactions file 
 
     """        
-    approved, declined, pending, end = prepare_transactions(impact, account_id, network, target_date)
+    transform_engine(engine) # Unknown engines fail before any file is created
+    end = target_date
+    file_label = f'{end:%Y-%m-%d_%H%M%S}' if windows is not None else f'{end:%Y-%m-%d}'
     transactions_filepath = f'transactions/{end.year}/{end:%m}/{end:%d}/{account_name.replace(" ","_")}'
     modifications_filepath = f'modifications/{end.year}/{end:%m}/{end:%d}/{account_name.replace(" ","_")}'
 
@@ -168,23 +351,60 @@ def transactions_process(impact, account_id, account_name, network, target_date)
 
     except FileExistsError as e:
         pass
-    file_path_p = Path(f'{transactions_filepath}/{account_name.replace(" ","_")}_{end:%Y-%m-%d}.csv')
-    file_path_m = Path(f'{modifications_filepath}/{account_name.replace(" ","_")}_{end:%Y-%m-%d}.csv')
-
-    logging.info(f'Approved transactions {len(approved)}')
-    logging.info(f'New pending transactions {len(pending)}')
-    logging.info(f'Declined transactions {len(declined)}')
-
-    headrow, t_list = new_transaction_lists(impact, [approved, declined, pending], account_name, network.network_name)
-    with open(file_path_p , 'w', newline="") as f:
-        csvwriter = csv.writer(f, delimiter = ',')
-        csvwriter.writerow(headrow)
-        csvwriter.writerows(t_list)
-
-    headrow, t_list = modified_transaction_lists(impact, approved, declined)
-    with open(file_path_m , 'w', newline="") as f:
-        csvwriter = csv.writer(f, delimiter = ',')
-        csvwriter.writerow(headrow)
-        csvwriter.writerows(t_list)
-
-    return file_path_m, file_path_p
\ No newline at end of file
+    file_path_p = Path(f'{transactions_filepath}/{account_name.replace(" ","_")}_{file_label}.csv')
+    file_path_m = Path(f'{modifications_filepath}/{account_name.replace(" ","_")}_{file_label}.csv')
+    if index is not None:
+        index.discard([file_path_m, file_path_p])
+
+    actions = None
+    if reconciler is not None:
+        if windows is not None:
+            actions = reconciler.load(min(start for start, _ in windows.values()), max(end for _, end in windows.values()))
+        else:
+            actions = reconciler.load(target_date, target_date)
+
+    counts = {'approved': 0, 'declined': 0, 'pending': 0}
+    written = {'conversions': 0, 'modifications': 0}
+    with open(file_path_p , 'w', newline="") as fp, open(file_path_m , 'w', newline="") as fm, \
+            (ConversionsParquetWriter(parquet_path(file_path_p)) if parquet else nullcontext()) as pqwriter:
+        conversions = csv.writer(fp, delimiter = ',')
+        modifications = csv.writer(fm, delimiter = ',')
+        conversions.writerow(NEW_TRANSACTION_HEADERS)
+        modifications.writerow(MODIFIED_TRANSACTION_HEADERS)
+        batches = batched(iter_transactions(network, account_id, target_date, windows=windows), batch_size)
+        if transform_pool is not None:
+            results = transform_pool.map(engine, batches, account_name, network.network_name)
+        else:
+            results = (transform_batch(impact, engine, batch, account_name, network.network_name) for batch in batches)
+        for batch_counts, new_list, modified_list in results:
+            for status, count in batch_counts.items():
+                counts[status] += count
+
+            t_list = new_list
+            if actions is not None:
+                t_list = reconciler.new_rows(actions, t_list)
+            if index is not None:
+                t_list = index.filter(file_path_p, 'new', network.network_name, t_list, NEW_TRANSACTION_KEY)
+            conversions.writerows(t_list)
+            written['conversions'] += len(t_list)
+            if pqwriter is not None:
+                pqwriter.write_rows(t_list)
+
+            t_list = modified_list
+            if actions is not None:
+                t_list = reconciler.modified_rows(actions, t_list)
+            if index is not None:
+                t_list = index.filter(file_path_m, 'modified', network.network_name, t_list, MODIFIED_TRANSACTION_KEY)
+            modifications.writerows(t_list)
+            written['modifications'] += len(t_list)
+
+    logging.info(f'Approved transactions {counts["approved"]}')
+    logging.info(f'New pending transactions {counts["pending"]}')
+    logging.info(f'Declined transactions {counts["declined"]}')
+    if metrics is not None:
+        for status, count in counts.items():
+            metrics.rows(network.network_name, account_name, 'in', count, status=status)
+        for file, count in written.items():
+            metrics.rows(network.network_name, account_name, 'out', count, file=file)
+
+    return file_path_m, file_path_p
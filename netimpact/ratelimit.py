@@ -0,0 +1,109 @@
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+
+class TokenBucket:
+    """Token bucket for a single host with additive increase/multiplicative decrease (AIMD) of the request rate.
+    Every successful request nudges the rate up towards max_rate, every throttled request halves it, so the bucket
+    settles just under the real quota of the API.
+
+    Keyword Arguments:
+        rate {float} -- Starting requests per second (default: {2})
+        burst {float} -- Maximum number of tokens that can be saved up (default: {5})
+        min_rate {float} -- Floor for the rate after repeated throttling (default: {0.05})
+        max_rate {float} -- Ceiling for the rate while probing upwards (default: {20})
+        increase {float} -- Requests per second added after each successful request (default: {0.05})
+        decrease {float} -- Factor the rate is multiplied by when throttled (default: {0.5})
+    """
+    def __init__(self, rate=2, burst=5, min_rate=0.05, max_rate=20, increase=0.05, decrease=0.5):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until one is available or until any Retry-After block has passed
+
+        Returns:
+            float -- Seconds spent sleeping
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = max(-self.tokens / self.rate, self.blocked_until - now, 0)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self, delay):
+        """Back off after a throttled response
+
+        Arguments:
+            delay {float} -- Seconds no request to the host should be sent for
+        """
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.tokens = min(self.tokens, 0)
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+
+
+class RateLimiter:
+    """Per-host token buckets shared by every client using the transport
+
+    Keyword Arguments:
+        limits {dict} -- {host : TokenBucket keyword arguments} overriding the defaults for specific hosts (default: {None})
+        backoff {float} -- Base seconds for the exponential backoff used when a throttled response has no Retry-After header (default: {1})
+        max_backoff {float} -- Cap on a single backoff in seconds (default: {300})
+    """
+    def __init__(self, limits=None, backoff=1, max_backoff=300):
+        self.limits = limits or {}
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, host):
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(**self.limits.get(host, {}))
+            return self.buckets[host]
+
+    def delay(self, attempt, retry_after=None):
+        """Seconds to wait before retrying a throttled request. Honours Retry-After (seconds or HTTP date) when given,
+        otherwise uses full jitter exponential backoff.
+
+        Arguments:
+            attempt {int} -- Number of throttled responses so far for this request, starting at 0
+
+        Keyword Arguments:
+            retry_after {string} -- Value of the Retry-After response header (default: {None})
+
+        Returns:
+            float -- Seconds to wait
+        """
+        if retry_after:
+            try:
+                seconds = float(retry_after)
+            except ValueError:
+                try:
+                    seconds = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+                except (TypeError, ValueError):
+                    seconds = None
+            if seconds is not None:
+                return min(max(seconds, 0), self.max_backoff) + random.uniform(0, self.backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
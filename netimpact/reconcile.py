@@ -0,0 +1,99 @@
+import logging
+import threading
+from datetime import timedelta
+
+from netimpact.processor import NEW_TRANSACTION_HEADERS, MODIFIED_TRANSACTION_HEADERS
+
+# Batch file columns the rows are joined on
+NEW_OID = NEW_TRANSACTION_HEADERS.index('OrderId')
+MODIFIED_OID, MODIFIED_AMOUNT, MODIFIED_REASON = (MODIFIED_TRANSACTION_HEADERS.index(h) for h in ('Oid', 'Amount', 'Reason'))
+# Impact action state a modification moves the action to
+REASON_STATES = {'VALIDATED_ORDER': 'approved', 'RETURNED': 'declined'}
+
+
+class Reconciler:
+    """Joins batch file rows against the actions Impact already has, so only the real delta is uploaded:
+    conversions whose OID Impact does not have yet, and modifications that change an action's state or amount.
+
+    The program's actions are loaded from the adv_action_listing report once per period into an index
+    {OID : (state, sale amount)} shared by every account of the run. Approvals and reversals arrive for actions made
+    well before the period, so the report is read from lookback before the period start.
+
+    Arguments:
+        impact {Impact} -- Impact object of the program
+
+    Keyword Arguments:
+        lookback {timedelta} -- How far before the period start Impact actions are loaded (default: {30 days})
+        date_format {string} -- START_DATE and END_DATE format of the report (default: {'%Y-%m-%d'})
+    """
+    states = ('pending', 'approved', 'declined')
+
+    def __init__(self, impact, lookback=timedelta(days=30), date_format='%Y-%m-%d'):
+        self.impact = impact
+        self.lookback = lookback
+        self.date_format = date_format
+        self.lock = threading.Lock()
+        self.indexes = {} # (start, end) -> {OID : (state, amount)}
+
+    def load(self, start, end):
+        """Impact action index for a period, read from Impact on first use. An index already loaded for a period covering it is reused.
+
+        Arguments:
+            start {datetime} -- Beginning of the period
+            end {datetime} -- End of the period
+
+        Returns:
+            dict -- {OID : (one of pending, approved, declined, sale amount)}
+        """
+        period = ((start - self.lookback).strftime(self.date_format), end.strftime(self.date_format))
+        with self.lock:
+            for (loaded_start, loaded_end), index in self.indexes.items():
+                if loaded_start <= period[0] and period[1] <= loaded_end:
+                    return index
+            logging.info(f'Loading Impact actions from {period[0]} to {period[1]} for reconciliation')
+            index = {}
+            for state in self.states:
+                for t in self.impact.iter_transactions(self.impact.program_id, *period, status=state):
+                    index[str(t['id'])] = (state, amount(t['saleAmount']['amount']))
+            logging.info(f'{len(index)} Impact actions loaded')
+            self.indexes[period] = index
+            return index
+
+    def new_rows(self, index, rows):
+        """Conversions rows whose OID is not an Impact action yet"""
+        kept = [r for r in rows if str(r[NEW_OID]) not in index]
+        if len(kept) < len(rows):
+            logging.info(f'Skipping {len(rows) - len(kept)} conversions already in Impact')
+        return kept
+
+    def modified_rows(self, index, rows):
+        """Modifications rows for actions Impact does not have yet (created by the conversions file of the same run),
+        or whose state or amount they change"""
+        kept = []
+        for r in rows:
+            action = index.get(str(r[MODIFIED_OID]))
+            if action is None:
+                kept.append(r)
+                continue
+            state, impact_amount = action
+            if state != REASON_STATES.get(r[MODIFIED_REASON], state):
+                kept.append(r)
+            elif r[MODIFIED_REASON] == 'VALIDATED_ORDER' and not same_amount(amount(r[MODIFIED_AMOUNT]), impact_amount):
+                kept.append(r)
+        if len(kept) < len(rows):
+            logging.info(f'Skipping {len(rows) - len(kept)} modifications already reflected in Impact')
+        return kept
+
+
+def amount(value):
+    """Sale amount as a float, None if it is not a number"""
+    try:
+        return float(str(value).replace(',', ''))
+    except ValueError:
+        return None
+
+
+def same_amount(a, b):
+    if a is None or b is None:
+        return a is b
+    return abs(a - b) < 0.005
@@ -0,0 +1,105 @@
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+MB = 1024 * 1024
+
+
+class S3Uploader:
+    """Upload stage for the run output files. One S3 client is shared by every account, large files go up as concurrent
+    multipart uploads, and files whose checksum matches the object already in the bucket are skipped.
+    Point endpoint_url at a local S3 stand-in (moto server, MinIO) to run it without AWS.
+
+    Arguments:
+        bucket {string} -- S3 bucket name
+
+    Keyword Arguments:
+        access_key {string} -- AWS access key ID, falls back to the default boto3 credential chain if not given (default: {None})
+        secret_access_key {string} -- AWS secret access key (default: {None})
+        endpoint_url {string} -- Custom S3 endpoint (default: {None})
+        region_name {string} -- AWS region (default: {None})
+        max_workers {int} -- Number of files uploaded at the same time (default: {4})
+        multipart_threshold {int} -- File size in bytes from which multipart upload is used (default: {8 MB})
+        multipart_chunksize {int} -- Size in bytes of each multipart part (default: {8 MB})
+        max_concurrency {int} -- Number of parts of a single file uploaded at the same time (default: {8})
+    """
+    def __init__(self, bucket, access_key=None, secret_access_key=None, endpoint_url=None, region_name=None,
+                 max_workers=4, multipart_threshold=8 * MB, multipart_chunksize=8 * MB, max_concurrency=8):
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+        from botocore.config import Config
+        self.bucket = bucket
+        self.max_workers = max_workers
+        session = boto3.session.Session(aws_access_key_id=access_key, aws_secret_access_key=secret_access_key, region_name=region_name)
+        self.client = session.client('s3', endpoint_url=endpoint_url,
+                                     config=Config(max_pool_connections=max_workers * max_concurrency))
+        self.transfer_config = TransferConfig(multipart_threshold=multipart_threshold, multipart_chunksize=multipart_chunksize,
+                                              max_concurrency=max_concurrency)
+
+    def checksums(self, path):
+        """MD5 hex digest of the file and the ETag S3 gives the object when it is uploaded with this transfer config
+
+        Arguments:
+            path {string} -- Local file path
+
+        Returns:
+            tuple -- (md5 hex digest, expected ETag)
+        """
+        md5 = hashlib.md5()
+        part_digests = []
+        size = 0
+        chunksize = self.transfer_config.multipart_chunksize
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunksize), b''):
+                size += len(chunk)
+                md5.update(chunk)
+                part_digests.append(hashlib.md5(chunk).digest())
+        if size < self.transfer_config.multipart_threshold:
+            return md5.hexdigest(), md5.hexdigest()
+        return md5.hexdigest(), f'{hashlib.md5(b"".join(part_digests)).hexdigest()}-{len(part_digests)}'
+
+    def is_current(self, key, md5, etag):
+        """True if the object already in the bucket has the same content as the local file"""
+        from botocore.exceptions import ClientError
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return head.get('Metadata', {}).get('md5') == md5 or head['ETag'].strip('"') == etag
+
+    def upload(self, path, key=None):
+        """Upload a single file unless the bucket already has an identical copy
+
+        Arguments:
+            path {string} -- Local file path
+
+        Keyword Arguments:
+            key {string} -- Object key, defaults to the relative file path (default: {None})
+
+        Returns:
+            bool -- True if the file was uploaded, False if it was skipped
+        """
+        key = key or str(path)
+        md5, etag = self.checksums(path)
+        if self.is_current(key, md5, etag):
+            logging.info(f'{key} already in {self.bucket}, skipping upload')
+            return False
+        self.client.upload_file(str(path), self.bucket, key, ExtraArgs={'Metadata': {'md5': md5}}, Config=self.transfer_config)
+        logging.info(f'{key} uploaded to {self.bucket}')
+        return True
+
+    def upload_all(self, paths):
+        """Upload files concurrently, skipping duplicates in the list
+
+        Arguments:
+            paths {list} -- Local file paths
+
+        Returns:
+            list -- Paths of the files that were uploaded
+        """
+        paths = list(dict.fromkeys(str(p) for p in paths))
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            uploaded = list(pool.map(self.upload, paths))
+        return [p for p, u in zip(paths, uploaded) if u]
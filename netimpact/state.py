@@ -0,0 +1,198 @@
+import hashlib
+import logging
+import math
+import os
+import sqlite3
+import threading
+from contextlib import closing
+from datetime import datetime, timedelta
+
+
+class StateStore:
+    """SQLite store for run state that has to survive between runs
+
+    Arguments:
+        path {string} -- Filepath of the SQLite database
+    """
+    tables = ()
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with closing(sqlite3.connect(self.path)) as conn, conn:
+            for table in self.tables:
+                conn.execute(table)
+
+    def connect(self):
+        return closing(sqlite3.connect(self.path, timeout=30))
+
+
+class Checkpoints(StateStore):
+    """Completed (network, account, day) imports, so an interrupted backfill restarts where it stopped"""
+    tables = ('CREATE TABLE IF NOT EXISTS checkpoints (network TEXT, account TEXT, day TEXT, completed_at TEXT, PRIMARY KEY (network, account, day))',)
+
+    def is_done(self, network_name, account_name, day):
+        with self.connect() as conn:
+            row = conn.execute('SELECT 1 FROM checkpoints WHERE network = ? AND account = ? AND day = ?',
+                               (network_name, account_name, f'{day:%Y-%m-%d}')).fetchone()
+        return row is not None
+
+    def mark_done(self, network_name, account_name, day):
+        with self.connect() as conn, conn:
+            conn.execute('INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?)',
+                         (network_name, account_name, f'{day:%Y-%m-%d}', datetime.now().isoformat()))
+
+
+class Watermarks(StateStore):
+    """High-water marks of the last successful sync per (network, account, status), so frequent runs only fetch the new window"""
+    tables = ('CREATE TABLE IF NOT EXISTS watermarks (network TEXT, account TEXT, status TEXT, synced_to TEXT, PRIMARY KEY (network, account, status))',)
+
+    def get(self, network_name, account_name, status):
+        with self.connect() as conn:
+            row = conn.execute('SELECT synced_to FROM watermarks WHERE network = ? AND account = ? AND status = ?',
+                               (network_name, account_name, status)).fetchone()
+        return datetime.fromisoformat(row[0]) if row else None
+
+    def windows(self, network, account_name, now, overlap=timedelta(0), default_start=None):
+        """Sync window for every status the network requests separately, from the last high-water mark (less the overlap
+        for late data) to now
+
+        Arguments:
+            network {object} -- Network object (currently one of AWin, Admitad, Linkshare)
+            account_name {string} -- Network program/account name
+            now {datetime} -- End of the window
+
+        Keyword Arguments:
+            overlap {timedelta} -- How far before the high-water mark the window starts again (default: {timedelta(0)})
+            default_start {datetime} -- Window start for statuses that have never been synced (default: {start of the day of now})
+
+        Returns:
+            dict -- {status : (start datetime, end datetime)}
+        """
+        if default_start is None:
+            default_start = datetime.combine(now.date(), datetime.min.time())
+        windows = {}
+        for status in network.statuses:
+            synced_to = self.get(network.network_name, account_name, status)
+            windows[status] = ((synced_to - overlap) if synced_to else default_start, now)
+        return windows
+
+    def advance(self, network_name, account_name, windows):
+        """Move the high-water marks to the end of the synced windows"""
+        with self.connect() as conn, conn:
+            conn.executemany('INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?, ?)',
+                             [(network_name, account_name, status, end.isoformat()) for status, (start, end) in windows.items()])
+
+
+class BloomFilter:
+    """Fixed size Bloom filter over string keys. A miss means the key was never added, a hit may be a false positive.
+
+    Keyword Arguments:
+        capacity {int} -- Number of keys the filter is sized for (default: {1000000})
+        error_rate {float} -- False positive rate at capacity (default: {0.001})
+    """
+    def __init__(self, capacity=1000000, error_rate=0.001):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + n * h2) % self.size for n in range(self.hashes)]
+
+    def add(self, key):
+        for p in self.positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self.positions(key))
+
+
+class SubmittedIndex(StateStore):
+    """Index of the batch file rows already uploaded to Impact, keyed by (OID, status, amount) per file kind and network,
+    so re-runs and overlapping windows only send real changes. A Bloom filter loaded from the table answers most lookups
+    for new rows without touching SQLite, hits are confirmed against the table.
+
+    Rows are staged against the batch file they were written to and only recorded once that file is uploaded (commit).
+
+    Arguments:
+        path {string} -- Filepath of the SQLite database
+
+    Keyword Arguments:
+        capacity {int} -- Minimum number of keys the Bloom filter is sized for (default: {1000000})
+    """
+    tables = ('CREATE TABLE IF NOT EXISTS submitted (key TEXT PRIMARY KEY, submitted_at TEXT)',)
+
+    def __init__(self, path, capacity=1000000):
+        super().__init__(path)
+        self.lock = threading.Lock()
+        self.staged = {}
+        with self.connect() as conn:
+            count = conn.execute('SELECT COUNT(*) FROM submitted').fetchone()[0]
+            self.bloom = BloomFilter(max(capacity, 2 * count))
+            for (key,) in conn.execute('SELECT key FROM submitted'):
+                self.bloom.add(key)
+
+    @staticmethod
+    def key(kind, network_name, oid, status, amount):
+        return f'{kind}|{network_name}|{oid}|{status}|{amount}'
+
+    def submitted(self, keys):
+        """Subset of keys already recorded as uploaded"""
+        with self.lock:
+            candidates = [k for k in keys if k in self.bloom]
+        found = set()
+        with self.connect() as conn:
+            for n in range(0, len(candidates), 500):
+                chunk = candidates[n:n + 500]
+                found.update(k for (k,) in conn.execute(f'SELECT key FROM submitted WHERE key IN ({",".join("?" * len(chunk))})', chunk))
+        return found
+
+    def filter(self, path, kind, network_name, rows, fields):
+        """Drop rows already uploaded (or already staged for the same file) and stage the rest against the batch file they go into.
+        A file written in several batches is filtered one batch at a time.
+
+        Arguments:
+            path {Path} -- Batch file the rows are written to
+            kind {string} -- Batch file kind, keys are only compared within a kind
+            network_name {string} -- Network name
+            rows {list} -- Batch file rows
+            fields {tuple} -- Column indices of the (OID, status, amount) key in a row
+
+        Returns:
+            list -- Rows still to upload
+        """
+        oid, status, amount = fields
+        keys = [self.key(kind, network_name, r[oid], r[status], r[amount]) for r in rows]
+        done = self.submitted(keys)
+        new_rows = []
+        with self.lock:
+            staged = self.staged.setdefault(str(path), {})
+            for row, key in zip(rows, keys):
+                if key in done or key in staged:
+                    continue
+                staged[key] = None
+                new_rows.append(row)
+        if len(new_rows) < len(rows):
+            logging.info(f'Skipping {len(rows) - len(new_rows)} {kind} rows already submitted to Impact')
+        return new_rows
+
+    def discard(self, paths):
+        """Forget the rows staged for the given batch files without recording them"""
+        with self.lock:
+            for p in paths:
+                self.staged.pop(str(p), None)
+
+    def commit(self, paths):
+        """Record the rows staged for the given batch files as uploaded"""
+        with self.lock:
+            keys = [k for p in paths for k in self.staged.pop(str(p), [])]
+            for key in keys:
+                self.bloom.add(key)
+        submitted_at = datetime.now().isoformat()
+        with self.connect() as conn, conn:
+            conn.executemany('INSERT OR IGNORE INTO submitted VALUES (?, ?)', [(k, submitted_at) for k in keys])
@@ -0,0 +1,146 @@
+import logging
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from netimpact.ratelimit import RateLimiter
+
+
+class Transport:
+    """Pooled HTTP transport shared by Impact and the network objects. Connections are kept alive and reused per host
+    instead of paying a new TCP and TLS handshake for every request.
+    Every request is paced by the per-host token bucket of the rate limiter, and throttled responses are retried with the
+    same method, URL, parameters and body after the backoff the rate limiter gives. A 429 means the request was refused and is
+    retried for every method. A 503 or 520 from a gateway can come back after the request was processed, so it is only retried
+    for idempotent methods. A POST (e.g. a partner creation) is only sent again after a 429.
+
+    Keyword Arguments:
+        pool_connections {int} -- Number of hosts to keep connection pools for (default: {10})
+        pool_maxsize {int} -- Maximum number of open connections kept per host (default: {10})
+        timeout {float or tuple} -- requests timeout, either a single value or (connect, read) in seconds (default: {(10, 300)})
+        rate_limiter {RateLimiter} -- Per-host rate limiter. A limiter with default limits is created if not given (default: {None})
+        max_retries {int} -- Number of times a throttled request is retried before the throttled response is returned (default: {10})
+        metrics {RunMetrics} -- Records requests, response bytes, throttled responses and rate limiter sleeps per host (default: {None})
+        cassette {Cassette} -- Records every response in record mode. In replay mode requests are answered from it without
+                               network access or rate limiting (default: {None})
+    """
+    throttle_codes = (429, 503, 520)
+    idempotent_methods = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, timeout=(10, 300), rate_limiter=None, max_retries=10, metrics=None, cassette=None):
+        self.timeout = tuple(timeout) if isinstance(timeout, list) else timeout
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.max_retries = max_retries
+        self.metrics = metrics
+        self.cassette = cassette
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+
+    def request(self, method, url, **kwargs):
+        """Send a request through the shared session
+
+        Arguments:
+            method {string} -- HTTP method
+            url {string} -- Request URL
+
+        Returns:
+            requests.response -- Response to the request
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        host = urlsplit(url).hostname
+        if self.cassette is not None and self.cassette.replaying:
+            r = self.cassette.replay(method, url, **kwargs)
+            if self.metrics is not None:
+                self.metrics.request(host, r.status_code, 0, 0)
+                self.metrics.response_bytes(host, len(r.content))
+            return r
+        bucket = self.rate_limiter.bucket(host)
+        attempt = 0
+        while True:
+            slept = bucket.acquire()
+            start = time.monotonic()
+            r = self.session.request(method, url, **kwargs)
+            if self.metrics is not None:
+                self.metrics.request(host, r.status_code, time.monotonic() - start, slept)
+            if not self.retryable(method, r.status_code):
+                if r.status_code not in self.throttle_codes:
+                    bucket.on_success()
+                if self.cassette is not None:
+                    self.cassette.record(method, url, r, **kwargs)
+                if self.metrics is not None:
+                    self.count_bytes(host, r, kwargs.get('stream', False))
+                return r
+            if self.metrics is not None:
+                self.metrics.throttled(host, r.status_code)
+            if attempt >= self.max_retries:
+                logging.error(f'Giving up on {method} {urlsplit(url).hostname}{urlsplit(url).path} after {attempt} retries ({r.status_code})')
+                if self.cassette is not None:
+                    self.cassette.record(method, url, r, **kwargs)
+                return r
+            delay = self.rate_limiter.delay(attempt, r.headers.get('Retry-After'))
+            logging.warning(f'{r.status_code} from {urlsplit(url).hostname}, retrying in {delay:.1f}s')
+            bucket.on_throttle(delay)
+            r.close()
+            attempt += 1
+
+    def retryable(self, method, status_code):
+        """True if a response with the status code is a throttle the request can safely be sent again for"""
+        if status_code == 429:
+            return True
+        return status_code in self.throttle_codes and method.upper() in self.idempotent_methods
+
+    def count_bytes(self, host, r, stream):
+        """Record the body size of a response. A streamed body is counted when the response is closed, once it has been read."""
+        if not stream:
+            self.metrics.response_bytes(host, len(r.content))
+            return
+        close = r.close
+        def counted_close():
+            self.metrics.response_bytes(host, r.raw.tell() if r.raw is not None else 0)
+            r.close = close
+            close()
+        r.close = counted_close
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def close(self):
+        self.session.close()
+        if self.cassette is not None:
+            self.cassette.close()
+
+
+_transport = None
+
+def get_transport():
+    """Return the process wide transport, creating one with the default settings on first use"""
+    global _transport
+    if _transport is None:
+        _transport = Transport()
+    return _transport
+
+def configure(rate_limits=None, **kwargs):
+    """Replace the process wide transport with one built from the given Transport keyword arguments
+
+    Keyword Arguments:
+        rate_limits {dict} -- {host : TokenBucket keyword arguments} for the shared rate limiter (default: {None})
+
+    Returns:
+        Transport -- The new shared transport
+    """
+    global _transport
+    if _transport is not None:
+        _transport.close()
+    _transport = Transport(rate_limiter=RateLimiter(rate_limits), **kwargs)
+    return _transport
@@ -1,9 +1,13 @@
+import re
 from setuptools import setup, find_packages
 
+with open('netimpact/__init__.py') as f:
+    version = re.search(r"__version__ = '([^']+)'", f.read()).group(1)
+
 setup(
     name='netimpact',
-    version='0.2.5',
-    packages=find_packages(),
+    version=version,
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     install_requires=[
         'Click',
         'requests',